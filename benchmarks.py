@@ -0,0 +1,233 @@
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from clients import SheetWriteBuffer
+from gspread.utils import numericise_all
+from helpers import (
+    SHEET_DATETIME_FORMAT,
+    clear_parsed_addresses,
+    format_sheet_datetime,
+    parse_addresses,
+    parse_sheet_datetime,
+    parse_sheet_datetimes,
+    use_parse_cache
+)
+from lead_frame import LeadFrame, mask_or
+
+LEAD_COLUMNS = 40
+SMS_QUEUED_COLUMNS = [30, 31, 32]
+
+
+def _payload_size(body: dict) -> int:
+    return len(json.dumps(body).encode("utf-8"))
+
+
+def _synthetic_leads(rows: int):
+    return [
+        [f"value {row}-{col}" if col % 3 else "" for col in range(LEAD_COLUMNS)]
+        for row in range(rows)
+    ]
+
+
+def bench_queue_writeback(row_counts=(1000, 10000, 100000), queued_counts=(3, 100)):
+    """
+    Compare bytes uploaded by queue_messages when rewriting the whole Leads Master from A2 against writing back only
+    the SMSnQueuedDateTime cells that changed.
+    """
+    time_queued_str = "10/18/2026 10:30:00"
+    print(f"{'rows':>8} {'queued':>8} {'full rewrite':>14} {'diff only':>12} {'ranges':>8}")
+    for rows in row_counts:
+        leads_values = _synthetic_leads(rows)
+        full_rewrite = _payload_size({"range": "A2", "majorDimension": "ROWS", "values": leads_values})
+
+        for queued in queued_counts:
+            cells = {}
+            for row_num in random.sample(range(2, rows + 2), min(queued, rows)):
+                cells[(row_num, random.choice(SMS_QUEUED_COLUMNS))] = time_queued_str
+            data = SheetWriteBuffer.merge_ranges(cells)
+            diff_only = _payload_size({"valueInputOption": "RAW", "data": data})
+
+            print(f"{rows:>8} {queued:>8} {full_rewrite:>14,} {diff_only:>12,} {len(data):>8}")
+
+
+def _synthetic_addresses(count: int):
+    streets = ["Main St", "Oak Ave", "State Ave", "Parallel Pkwy", "N 7th St Trfy", "Leavenworth Rd", "Minnesota Ave"]
+    cities = [("Kansas City", "KS", "661"), ("Topeka", "KS", "666"), ("Olathe", "KS", "660"), ("Kansas City", "MO", "641")]
+    addresses = []
+    for index in range(count):
+        city, state, zip_prefix = cities[index % len(cities)]
+        unit = f" Apt {index % 97}" if index % 5 == 0 else ""
+        addresses.append(f"{index + 100} {streets[index % len(streets)]}{unit}, {city}, {state} {zip_prefix}{index % 100:02d}")
+    return addresses
+
+
+def bench_parse_addresses(sizes=(10000, 100000, 1000000)):
+    """
+    Time parse_addresses on unique synthetic addresses with 1 worker up to the number of CPUs, with every cache cold.
+    """
+    use_parse_cache(None)
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, 8, cpu_count} & set(range(1, cpu_count + 1)))
+
+    print(f"{'addresses':>10} {'workers':>8} {'seconds':>10} {'addr/s':>10} {'speedup':>8}")
+    for size in sizes:
+        addresses = _synthetic_addresses(size)
+        serial_seconds = None
+        for workers in worker_counts:
+            clear_parsed_addresses()
+            start = time.perf_counter()
+            parse_addresses(addresses, workers=workers)
+            seconds = time.perf_counter() - start
+            serial_seconds = serial_seconds or seconds
+
+            print(f"{size:>10} {workers:>8} {seconds:>10.2f} {size / seconds:>10,.0f} {serial_seconds / seconds:>8.2f}")
+
+
+LEADS_MASTER_HEADER = [
+    "TargetStreet", "TargetCity", "TargetState", "TargetZip", "ContactFirstName", "ContactLastName",
+    "ContactStreet", "ContactCity", "ContactState", "ContactZip", "ContactPhone1", "ContactPhone2", "ContactPhone3",
+    "SkipTraceSuccess", "Type", "Source", "DateTimeAdded",
+    "SMS1QueuedDateTime", "SMS2QueuedDateTime", "SMS3QueuedDateTime",
+    "SMS1SentDateTime", "SMS2SentDateTime", "SMS3SentDateTime"
+]
+
+
+def _synthetic_leads_master(rows: int):
+    values = [LEADS_MASTER_HEADER]
+    for index in range(rows):
+        traced = index % 3 == 0
+        queued = index % 6 == 0
+        stamp = f"{index % 12 + 1:02d}/{index % 28 + 1:02d}/2026 {index % 24:02d}:{index % 60:02d}:00"
+        values.append([
+            f"{index + 100} Main St", "Kansas City", "KS", f"661{index % 100:02d}", "Pat", f"Owner{index}",
+            f"{index + 100} Oak Ave", "Kansas City", "KS", f"661{index % 100:02d}",
+            f"913555{index % 10000:04d}" if traced else "", "", "",
+            "TRUE" if traced else "", "Code Violation", "WYAN", stamp,
+            stamp if queued else "", "", "",
+            stamp if queued else "", "", ""
+        ])
+    return values
+
+
+def _record_needs_skip_trace(lead: dict) -> bool:
+    # The per-record check skip_trace() used before LeadFrame.skip_trace_mask(), kept as the baseline
+    return bool(
+        lead["SkipTraceSuccess"] == "" and lead["ContactCity"] and lead["ContactStreet"] and lead["ContactState"]
+        and lead["ContactZip"] and not (lead["ContactPhone1"] and lead["ContactPhone2"] and lead["ContactPhone3"])
+    )
+
+
+def _record_needs_queuing(lead: dict) -> bool:
+    # The per-record check queue_messages() used before LeadFrame.queue_mask(), kept as the baseline
+    return bool(
+        (lead["SMS1QueuedDateTime"] == "" or lead["SMS2QueuedDateTime"] == "" or lead["SMS3QueuedDateTime"] == "")
+        and lead["TargetStreet"]
+    )
+
+
+def _build_stats(build):
+    """Returns the result of build, the seconds it took and the MiB it holds on to (measured in a second run)"""
+    start = time.perf_counter()
+    result = build()
+    seconds = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = build()
+    memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    return result, seconds, memory
+
+
+def bench_lead_frame(sizes=(10000, 100000)):
+    """
+    Compare memory and eligibility scan time of Leads Master held as get_all_records dicts, scanned with the per-record
+    checks the scripts used before, against the LeadFrame and masks skip_trace() and queue_messages() use now.
+    """
+    print(f"{'rows':>8} {'layout':>8} {'build s':>9} {'MiB':>8} {'scan s':>8}")
+    for rows in sizes:
+        values = _synthetic_leads_master(rows)
+
+        records, build_seconds, memory = _build_stats(
+            lambda: [dict(zip(values[0], numericise_all(row))) for row in values[1:]]
+        )
+        start = time.perf_counter()
+        eligible = [index for index, lead in enumerate(records) if _record_needs_skip_trace(lead) or _record_needs_queuing(lead)]
+        scan_seconds = time.perf_counter() - start
+        print(f"{rows:>8} {'records':>8} {build_seconds:>9.2f} {memory:>8.1f} {scan_seconds:>8.3f}")
+        del records
+
+        frame, build_seconds, memory = _build_stats(lambda: LeadFrame.from_values(values))
+        start = time.perf_counter()
+        frame_eligible = frame.where(mask_or(frame.skip_trace_mask(), frame.queue_mask()))
+        scan_seconds = time.perf_counter() - start
+        print(f"{rows:>8} {'frame':>8} {build_seconds:>9.2f} {memory:>8.1f} {scan_seconds:>8.3f}")
+
+        assert frame_eligible == eligible
+
+
+def bench_sheet_datetime(sizes=(10000, 100000), unique_ratios=(1.0, 0.1)):
+    """
+    Time parsing and formatting a column of sheet timestamps with strptime/strftime against the shared codec, cold
+    (cache cleared) and warm, on columns where every value is unique or most values repeat.
+    """
+    print(f"{'values':>8} {'unique':>7} {'strptime':>9} {'codec':>7} {'warm':>7} {'bulk':>7} {'strftime':>9} {'format':>7}")
+    for size in sizes:
+        for unique_ratio in unique_ratios:
+            unique = max(1, int(size * unique_ratio))
+            base = datetime.datetime(2026, 1, 1)
+            stamps = [base + datetime.timedelta(seconds=97 * (index % unique)) for index in range(size)]
+            values = [stamp.strftime(SHEET_DATETIME_FORMAT) for stamp in stamps]
+
+            start = time.perf_counter()
+            expected = [datetime.datetime.strptime(value, SHEET_DATETIME_FORMAT) for value in values]
+            strptime_seconds = time.perf_counter() - start
+
+            parse_sheet_datetime.cache_clear()
+            start = time.perf_counter()
+            parsed = [parse_sheet_datetime(value) for value in values]
+            codec_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            [parse_sheet_datetime(value) for value in values]
+            warm_seconds = time.perf_counter() - start
+
+            parse_sheet_datetime.cache_clear()
+            start = time.perf_counter()
+            bulk = parse_sheet_datetimes(values)
+            bulk_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            [stamp.strftime(SHEET_DATETIME_FORMAT) for stamp in stamps]
+            strftime_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            formatted = [format_sheet_datetime(stamp) for stamp in stamps]
+            format_seconds = time.perf_counter() - start
+
+            assert parsed == expected and bulk == expected and formatted == values
+            print(
+                f"{size:>8} {unique:>7} {strptime_seconds:>9.3f} {codec_seconds:>7.3f} {warm_seconds:>7.3f} "
+                f"{bulk_seconds:>7.3f} {strftime_seconds:>9.3f} {format_seconds:>7.3f}"
+            )
+
+
+BENCHMARKS = {
+    "queue_writeback": bench_queue_writeback,
+    "parse_addresses": bench_parse_addresses,
+    "lead_frame": bench_lead_frame,
+    "sheet_datetime": bench_sheet_datetime,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
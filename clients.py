@@ -1,5 +1,7 @@
 import asyncio
+import email.utils
 import gspread
+import itertools
 import json
 import logging
 import os
@@ -7,14 +9,23 @@ import pyppeteer
 import random
 import re
 import requests
+import threading
 import time
 import traceback
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
 
 from appium import webdriver
 from appium.options.android import UiAutomator2Options
 from appium.webdriver.common.appiumby import AppiumBy
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from helpers import Address
+from gspread.utils import Dimension, numericise_all, rowcol_to_a1
+from helpers import RateLimiter, normalize_address_key, parse_addresses
+from lead_frame import LeadFrame
+from storage import SheetMirror, SkipTraceCache
 from pyppeteer.browser import Browser
 from pyppeteer.page import Page
 from pyppeteer.element_handle import ElementHandle
@@ -23,19 +34,70 @@ from pyppeteer.errors import TimeoutError
 from python_ghost_cursor.pyppeteer import create_cursor
 from selenium.common.exceptions import (
     NoSuchElementException,
-    TimeoutException
+    TimeoutException,
+    WebDriverException
 )
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.ui import WebDriverWait
 from oauth2client.service_account import ServiceAccountCredentials
+from urllib3.util.retry import Retry
 
-from typing import Union, List, Dict, Tuple
+from typing import Any, Union, List, Dict, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, quota state is then only shared between threads
+    fcntl = None
 
 
 class BatchAPIError(Exception):
     pass
 
+
+class ScreenSnapshot:
+    """
+    One parsed copy of the UI hierarchy returned by page_source.
+
+    Looking elements up in a snapshot costs no round trip to Appium, so any number of presence checks can be answered
+    from a single fetch instead of one WebDriverWait each. Elements are indexed by resource-id on parse.
+    """
+
+    def __init__(self, page_source: str):
+        self.root = ElementTree.fromstring(page_source)
+        self.by_id: Dict[str, List[ElementTree.Element]] = defaultdict(list)
+        for element in self.root.iter():
+            resource_id = element.get("resource-id")
+            if resource_id:
+                self.by_id[resource_id].append(element)
+
+    def find_all(self, resource_id: str = None, text: str = None, within: str = None) -> List[ElementTree.Element]:
+        """
+        Find elements in the snapshot.
+
+        :param resource_id: The full resource-id the elements must have.
+        :param text: The text the elements must have.
+        :param within: Only search inside elements with this resource-id.
+        :return: The matching elements in document order.
+        """
+        if within:
+            candidates = [element for container in self.by_id.get(within, []) for element in container.iter()]
+        elif resource_id:
+            candidates = self.by_id.get(resource_id, [])
+        else:
+            candidates = self.root.iter()
+
+        return [
+            element for element in candidates
+            if (resource_id is None or element.get("resource-id") == resource_id)
+            and (text is None or element.get("text") == text)
+        ]
+
+    def has(self, resource_id: str = None, text: str = None, within: str = None) -> bool:
+        """Checks if an element is present in the snapshot, takes the same arguments as find_all"""
+        return bool(self.find_all(resource_id, text, within))
+
+
 class AppiumClient:
     def __init__(
         self,
@@ -86,6 +148,70 @@ class AppiumClient:
             self.driver.quit()
             self.logger.debug("Driver was quit")
 
+    def is_alive(self) -> bool:
+        """Checks that the driver session still answers"""
+        if self.driver is None:
+            return False
+
+        try:
+            self.driver.current_package
+        except WebDriverException:
+            return False
+        return True
+
+    def recreate(self):
+        """Replaces the driver session with a new one, the old one is quit on a best effort basis"""
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException as e:
+                self.logger.debug(f"Quitting the old session failed: {e}")
+            self.driver = None
+
+        self.open()
+
+    def ensure_app_foreground(self) -> bool:
+        """
+        Brings the app back to the foreground if something else took over the screen.
+
+        :return: True if the app had to be activated.
+        """
+        if self.driver.current_package != self.capabilities["appPackage"]:
+            self.logger.info(f"{self.capabilities['appPackage']} is not in the foreground, activating it")
+            self.driver.activate_app(self.capabilities["appPackage"])
+            return True
+        return False
+
+    def snapshot(self) -> ScreenSnapshot:
+        """Fetches the UI hierarchy once and parses it for local lookups"""
+        return ScreenSnapshot(self.driver.page_source)
+
+    def wait_for_snapshot(self, condition, timeout: float = 1, poll_interval: float = 0.25) -> ScreenSnapshot:
+        """
+        Fetches snapshots until one satisfies the condition or the timeout runs out.
+
+        :param condition: Called with each snapshot, returns True when the screen is in the expected state.
+        :param timeout: Seconds to keep fetching for.
+        :param poll_interval: Seconds to wait between fetches.
+        :return: The first snapshot satisfying the condition, or the last one fetched.
+        """
+        deadline = time.monotonic() + timeout
+        snapshot = self.snapshot()
+        while not condition(snapshot) and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            snapshot = self.snapshot()
+
+        return snapshot
+
+    @contextmanager
+    def timed_step(self, timings: Dict[str, float], name: str):
+        """Adds the time spent in the block to timings under name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
     def locate(self, by, locator, location_type=None):
         """Locates the first elements with the given By"""
         wait = WebDriverWait(self.driver, 10)
@@ -814,7 +940,7 @@ class WYANGovClient(BasePuppeteerClient):
         await self.click('a[id="ctl00_PlaceHolderMain_btnNewSearch"]')
         await self.sleep(4)
 
-        leads = []
+        violations = []
         page_elements = await self.find_all('.aca_pagination_td')
         for _ in range(len(page_elements[2:-1])):
             code_violations = await self.find_all(".ACA_TabRow_Odd, .ACA_TabRow_Even")
@@ -826,25 +952,46 @@ class WYANGovClient(BasePuppeteerClient):
                 if not self.check_case_number(case_number):
                     address_element = await code_violation.querySelector('[id$="_lblAddress"]')
                     address = await self.page.evaluate('(element) => element.textContent', address_element)
-                    address_obj = Address(address)
-
-                    lead = {
-                        "lead_type": self.get_type_display_name(case_number),
-                        "address": address_obj
-                    }
-
-                    leads.append(lead)
+                    violations.append((case_number, address))
 
             pagination_buttons = await self.find_all('.aca_pagination_PrevNext')
             await pagination_buttons[-1].click()
 
             await self.sleep(2, 4)
 
+        # Addresses are parsed in one batch once every page has been scraped
+        leads = []
+        addresses = parse_addresses([address for _, address in violations])
+        for (case_number, address), address_obj in zip(violations, addresses):
+            if address_obj is None:
+                self.logger.warning(f"Could not parse address \"{address}\" for case {case_number}")
+                continue
+
+            lead = {
+                "lead_type": self.get_type_display_name(case_number),
+                "address": address_obj
+            }
+
+            leads.append(lead)
+
         return leads
 
 
 class HushedClient(AppiumClient):
-    def __init__(self, uuid: str, logger: logging.Logger, appium_url: str):
+    DRAWER_NUMBER_ID = "com.hushed.release:id/drawer_number_subtitle"
+    SELECTED_NUMBER_ID = "com.hushed.release:id/tvTitle"
+    HEADER_ID = "com.hushed.release:id/collapsibleHeader"
+    BACK_BUTTON_ID = "com.hushed.release:id/headerButtonLeft"
+    SEARCH_ID = "com.hushed.release:id/etSearch"
+
+    def __init__(
+        self,
+        uuid: str,
+        logger: logging.Logger,
+        appium_url: str,
+        system_port: int = None,
+        mjpeg_server_port: int = None
+    ):
         capabilities = dict(
             platformName="Android",
             automationName="uiautomator2",
@@ -855,28 +1002,74 @@ class HushedClient(AppiumClient):
             noReset=True,
             forceAppLaunch=True,
         )
-        super(HushedClient, self).__init__(uuid, capabilities, logger, appium_url)
+        super(HushedClient, self).__init__(uuid, capabilities, logger, appium_url, system_port, mjpeg_server_port)
+        self.screen = None
+        self.active_number = None
+        self.last_send_timings: Dict[str, float] = {}
+
+    def open(self):
+        super(HushedClient, self).open()
+        self.reset_screen_state()
+
+    def ensure_app_foreground(self) -> bool:
+        activated = super(HushedClient, self).ensure_app_foreground()
+        if activated:
+            self.reset_screen_state()
+        return activated
+
+    def reset_screen_state(self):
+        """Forgets which screen and sender number are active, the next send navigates from whatever is on screen"""
+        self.screen = None
+        self.active_number = None
+
+    def on_messages_screen(self, snapshot: ScreenSnapshot, number: str) -> bool:
+        """Checks if a snapshot shows the messages list of the given sender number"""
+        return (
+            snapshot.has(text="Messages", within=self.HEADER_ID)
+            and snapshot.has(self.SELECTED_NUMBER_ID, text=number)
+        )
 
     def go_to_messages_screen(self, number: str):
-        number_xpath = f'//android.widget.TextView[@resource-id="com.hushed.release:id/drawer_number_subtitle" and @text="{number}"]'
-        selected_number_xpath = f'//android.widget.TextView[@resource-id="com.hushed.release:id/tvTitle" and @text="{number}"]'
-        if self.is_present(AppiumBy.XPATH, number_xpath):
-            number_btn = self.locate(AppiumBy.XPATH, number_xpath)
-            self.click(number_btn)
+        """
+        Open the messages list of a sender number.
+
+        Presence checks are answered from page source snapshots, one fetch covering every check made on a screen. When
+        the last send was from the same number, the conversation it left open is closed with a single back press
+        instead of working out the screen from scratch. That only happens on devices with a single number or with
+        rotate_sender_numbers turned off, see send_sms.claim_and_send().
+
+        :param number: The sender number as shown in the app.
+        """
+        number_xpath = f'//android.widget.TextView[@resource-id="{self.DRAWER_NUMBER_ID}" and @text="{number}"]'
+        if self.active_number == number and self.screen == "messages":
+            return
+
+        if self.active_number == number and self.screen == "conversation":
+            self.click(self.locate(AppiumBy.ID, self.BACK_BUTTON_ID))
+            snapshot = self.wait_for_snapshot(lambda snapshot: self.on_messages_screen(snapshot, number))
+            if self.on_messages_screen(snapshot, number):
+                self.screen = "messages"
+                return
+        else:
+            snapshot = self.snapshot()
+
+        self.reset_screen_state()
+        if snapshot.has(self.DRAWER_NUMBER_ID, text=number):
+            self.click(self.locate(AppiumBy.XPATH, number_xpath))
+            self.screen = "messages"
+            self.active_number = number
             return
 
-        on_message_screen = self.is_present(AppiumBy.XPATH, "//android.widget.LinearLayout[@resource-id='com.hushed.release:id/collapsibleHeader']//android.widget.TextView[@text='Messages']")
-        number_selected = self.is_present(AppiumBy.XPATH, selected_number_xpath)
-        if not (on_message_screen and number_selected):
-            back_btn_id = "com.hushed.release:id/headerButtonLeft"
+        number_selected = snapshot.has(self.SELECTED_NUMBER_ID, text=number)
+        if not (number_selected and self.on_messages_screen(snapshot, number)):
             tries = 0
-            while self.is_present(AppiumBy.ID, back_btn_id) and not number_selected and tries < 3:
-                back_btn = self.locate(AppiumBy.ID, back_btn_id)
-                self.click(back_btn)
-                number_selected = self.is_present(AppiumBy.XPATH, selected_number_xpath)
+            while snapshot.has(self.BACK_BUTTON_ID) and not number_selected and tries < 3:
+                self.click(self.locate(AppiumBy.ID, self.BACK_BUTTON_ID))
+                snapshot = self.wait_for_snapshot(lambda snapshot: snapshot.has(self.SELECTED_NUMBER_ID, text=number))
+                number_selected = snapshot.has(self.SELECTED_NUMBER_ID, text=number)
                 tries += 1
 
-            if not self.is_present(AppiumBy.XPATH, number_xpath) and not number_selected:
+            if not snapshot.has(self.DRAWER_NUMBER_ID, text=number) and not number_selected:
                 hamburger_menu = self.locate(AppiumBy.ID, "com.hushed.release:id/btnHamburger")
                 self.click(hamburger_menu)
 
@@ -884,45 +1077,421 @@ class HushedClient(AppiumClient):
                 number_btn = self.locate(AppiumBy.XPATH, number_xpath)
                 self.click(number_btn)
 
+        self.screen = "messages"
+        self.active_number = number
+
     def send_sms(self, sender_number: str, recipient: str, message: str):
-        self.go_to_messages_screen(sender_number)
+        """
+        Send a message from one of the numbers logged in to the app.
 
-        self.sleep(2)
+        The time spent in each step is logged as a latency breakdown and kept in last_send_timings.
+
+        :param sender_number: The sender number as shown in the app.
+        :param recipient: The number to send to.
+        :param message: The message text.
+        """
+        timings = {}
+        try:
+            with self.timed_step(timings, "navigate"):
+                self.go_to_messages_screen(sender_number)
 
-        new_message_btn = self.locate(AppiumBy.ID, 'com.hushed.release:id/btnMessageCompose')
-        self.click(new_message_btn)
+            with self.timed_step(timings, "settle"):
+                self.sleep(2)
 
-        got_it_id = "com.hushed.release:id/btnAgree"
-        if self.is_present(AppiumBy.ID, got_it_id):
-            got_it_btn = self.locate(AppiumBy.ID, got_it_id)
-            self.click(got_it_btn)
+            with self.timed_step(timings, "compose"):
+                new_message_btn = self.locate(AppiumBy.ID, "com.hushed.release:id/btnMessageCompose")
+                self.click(new_message_btn)
+                self.screen = "conversation"
 
-            deny_button_id = "com.android.packageinstaller:id/permission_deny_button"
-            if self.is_present(AppiumBy.ID, deny_button_id):
-                deny_btn = self.locate(AppiumBy.ID, deny_button_id)
-                self.click(deny_btn)
+                # One wait covers both the search field and the first use prompt instead of probing for the prompt
+                got_it_id = "com.hushed.release:id/btnAgree"
+                snapshot = self.wait_for_snapshot(
+                    lambda snapshot: snapshot.has(self.SEARCH_ID) or snapshot.has(got_it_id), timeout=10
+                )
+                if snapshot.has(got_it_id):
+                    got_it_btn = self.locate(AppiumBy.ID, got_it_id)
+                    self.click(got_it_btn)
 
-        number_search = self.locate(AppiumBy.ID, "com.hushed.release:id/etSearch")
-        self.send_keys(number_search, recipient)
+                    deny_button_id = "com.android.packageinstaller:id/permission_deny_button"
+                    snapshot = self.wait_for_snapshot(
+                        lambda snapshot: snapshot.has(self.SEARCH_ID) or snapshot.has(deny_button_id)
+                    )
+                    if snapshot.has(deny_button_id):
+                        deny_btn = self.locate(AppiumBy.ID, deny_button_id)
+                        self.click(deny_btn)
+
+            with self.timed_step(timings, "recipient"):
+                number_search = self.locate(AppiumBy.ID, self.SEARCH_ID)
+                self.send_keys(number_search, recipient)
+
+                no_match_tile = self.locate(AppiumBy.ID, "com.hushed.release:id/noMatchNumber")
+                self.click(no_match_tile)
+
+            with self.timed_step(timings, "message"):
+                message_input = self.locate(AppiumBy.ID, "com.hushed.release:id/message_content")
+                self.send_keys(message_input, message)
+
+            with self.timed_step(timings, "send"):
+                send_btn = self.locate(AppiumBy.ID, "com.hushed.release:id/btnSend")
+                self.click(send_btn)
+        except BaseException:
+            self.reset_screen_state()
+            raise
+        finally:
+            self.last_send_timings = timings
+            self.logger.info(
+                "Send latency: "
+                + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+                + f", total {sum(timings.values()):.2f}s"
+            )
 
-        no_match_tile = self.locate(AppiumBy.ID, "com.hushed.release:id/noMatchNumber")
-        self.click(no_match_tile)
 
-        message_input = self.locate(AppiumBy.ID, "com.hushed.release:id/message_content")
-        self.send_keys(message_input, message)
+class SheetsRequestExecutor:
+    """
+    Runs Google Sheets API calls under a token bucket sized to the per-minute quota.
 
-        send_btn = self.locate(AppiumBy.ID, "com.hushed.release:id/btnSend")
-        self.click(send_btn)
+    The bucket lives in a small state file guarded by an exclusive file lock, so every process pointing at the same
+    file (lead_generator.py, leads_manager.py and send_sms.py) draws from one shared budget. Rate limited (429) and
+    transient (5xx) responses are retried with full-jitter exponential backoff, honoring Retry-After when it is sent,
+    and a 429 blocks the bucket for all processes until the wait is over.
+    """
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        state_path: str,
+        logger: logging.Logger,
+        requests_per_minute: int = 60,
+        max_retries: int = 6,
+        base_delay: float = 1,
+        max_delay: float = 64
+    ):
+        self.state_path = state_path
+        self.logger = logger
+        self.capacity = requests_per_minute
+        self.refill_rate = requests_per_minute / 60
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        with self.thread_lock, open(self.state_path, "a+") as state_file:
+            if fcntl:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read() or "{}")
+                except ValueError:
+                    state = {}
+
+                yield state
+
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Blocks until a request token is available in the shared bucket"""
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                elapsed = max(now - state.get("updated", now), 0)
+                tokens = min(self.capacity, state.get("tokens", self.capacity) + elapsed * self.refill_rate)
+                state["updated"] = now
+
+                blocked_until = state.get("blocked_until", 0)
+                if blocked_until > now:
+                    state["tokens"] = tokens
+                    wait_time = blocked_until - now
+                elif tokens >= 1:
+                    state["tokens"] = tokens - 1
+                    return
+                else:
+                    state["tokens"] = tokens
+                    wait_time = (1 - tokens) / self.refill_rate
+
+            time.sleep(wait_time)
+
+    def block(self, seconds: float):
+        """Stops every process sharing the bucket from sending requests for the given number of seconds"""
+        with self._locked_state() as state:
+            state["blocked_until"] = max(state.get("blocked_until", 0), time.time() + seconds)
+
+    @staticmethod
+    def _retry_after(response) -> Union[None, float]:
+        value = response.headers.get("Retry-After") if response is not None else None
+        if not value:
+            return None
+
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                return None
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, func, *args, **kwargs):
+        """
+        Run a Sheets API call through the shared rate limiter, retrying throttled and transient failures.
+
+        Every call is assumed safe to repeat: reads, and writes to explicit ranges (the importers write appended rows
+        to the cells after the last used row rather than through the append endpoint).
+
+        :param func: The gspread callable to run.
+        :return: Whatever func returns.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.code not in self.RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                    raise
+
+                retry_after = self._retry_after(e.response)
+                wait_time = retry_after if retry_after is not None else self._backoff(attempt)
+                if e.code == 429:
+                    self.block(wait_time)
+                self.logger.warning(f"Sheets API returned {e.code}. Waiting for {round(wait_time, 2)} seconds before retrying...")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+
+                wait_time = self._backoff(attempt)
+                self.logger.warning(f"Sheets API request failed ({e}). Waiting for {round(wait_time, 2)} seconds before retrying...")
+
+            time.sleep(wait_time)
+
+
+class SheetWriteBuffer:
+    """
+    Collects cell and range writes for a single worksheet and sends them as one batch_update.
+
+    Staged cells are merged into the fewest rectangular ranges possible (runs of adjacent columns on a row, then runs of
+    identical column spans on consecutive rows). The buffer flushes when it holds max_cells cells or cells on max_rows
+    rows, flush_interval seconds after the first unflushed write, and on context exit.
+    """
+
+    def __init__(
+        self,
+        sheet_client: "GoogleSheetClient",
+        sheet: gspread.Worksheet,
+        max_cells: int = 5000,
+        flush_interval: float = 30,
+        raw: bool = True,
+        max_rows: int = None
+    ):
+        self.sheet_client = sheet_client
+        self.sheet = sheet
+        self.max_cells = max_cells
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.raw = raw
+        self.cells: Dict[Tuple[int, int], Any] = {}
+        # Rows with at least one staged cell
+        self.rows: Set[int] = set()
+        self.lock = threading.RLock()
+        self.timer: Union[None, threading.Timer] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def update_cell(self, row: int, col: int, value):
+        """Stages a single cell write (1-based row and column)"""
+        with self.lock:
+            self.cells[(row, col)] = value
+            self.rows.add(row)
+            self._after_write()
+
+    def update_row(self, row: int, values: list, start_col: int = 1):
+        """Stages a run of cells on one row starting at start_col (1-based)"""
+        with self.lock:
+            for offset, value in enumerate(values):
+                self.cells[(row, start_col + offset)] = value
+            if values:
+                self.rows.add(row)
+            self._after_write()
+
+    def update(self, values: List[list], start_row: int, start_col: int = 1):
+        """Stages a block of rows whose top left cell is at start_row and start_col (1-based)"""
+        with self.lock:
+            for row_offset, row_values in enumerate(values):
+                for col_offset, value in enumerate(row_values):
+                    self.cells[(start_row + row_offset, start_col + col_offset)] = value
+                if row_values:
+                    self.rows.add(start_row + row_offset)
+            self._after_write()
+
+    def _after_write(self):
+        if len(self.cells) >= self.max_cells or (self.max_rows and len(self.rows) >= self.max_rows):
+            self.flush()
+        elif self.timer is None and self.flush_interval:
+            self.timer = threading.Timer(self.flush_interval, self._flush_from_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self.logger.error(f"Timed flush of {self.sheet.title} failed: {e}", exc_info=True)
+
+    @property
+    def logger(self):
+        return self.sheet_client.logger
+
+    @staticmethod
+    def merge_ranges(cells: Dict[Tuple[int, int], Any]) -> List[Dict]:
+        """
+        Merge cells into a minimal list of rectangular ranges in the format batch_update expects.
+
+        :param cells: A mapping of (row, col) to value.
+        :return: A list of {"range": "A1:B2", "values": [[...], ...]} dictionaries.
+        """
+        rows = defaultdict(dict)
+        for (row, col), value in cells.items():
+            rows[row][col] = value
+
+        # First collapse each row into runs of adjacent columns
+        runs = []
+        for row in sorted(rows):
+            cols = sorted(rows[row])
+            start_col = cols[0]
+            values = [rows[row][start_col]]
+            for previous_col, col in zip(cols, cols[1:]):
+                if col == previous_col + 1:
+                    values.append(rows[row][col])
+                else:
+                    runs.append((row, start_col, values))
+                    start_col = col
+                    values = [rows[row][col]]
+            runs.append((row, start_col, values))
+
+        # Then stack runs covering the same columns on consecutive rows into blocks
+        blocks = []
+        open_blocks = {}
+        for row, start_col, values in runs:
+            key = (start_col, len(values))
+            block = open_blocks.get(key)
+            if block and block["end_row"] == row - 1:
+                block["values"].append(values)
+                block["end_row"] = row
+            else:
+                block = {"start_row": row, "end_row": row, "start_col": start_col, "values": [values]}
+                open_blocks[key] = block
+                blocks.append(block)
+
+        return [
+            {
+                "range": f"{rowcol_to_a1(block['start_row'], block['start_col'])}:"
+                         f"{rowcol_to_a1(block['end_row'], block['start_col'] + len(block['values'][0]) - 1)}",
+                "values": block["values"]
+            }
+            for block in blocks
+        ]
+
+    def flush(self):
+        """Sends every staged write in a single batch_update"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.cells:
+                return
+
+            cells = self.cells
+            self.cells = {}
+            self.rows = set()
+
+            data = self.merge_ranges(cells)
+            try:
+                self.sheet_client.execute(self.sheet.batch_update, data, raw=self.raw)
+            except Exception:
+                # Put the writes back so a later flush can retry them, without clobbering newer values
+                for key, value in cells.items():
+                    self.cells.setdefault(key, value)
+                self.rows.update(row for row, _ in cells)
+                raise
+
+            if any(row == 1 for row, _ in cells):
+                self.sheet_client.invalidate_schema(self.sheet.title)
+
+            self.logger.info(f"Flushed {len(cells)} cells to {self.sheet.title} in {len(data)} ranges")
+
+
+class SheetSchema:
+    """Header row of a worksheet, mapping every column name to its 1-based index"""
+
+    def __init__(self, header: List[str]):
+        self.header = self._strip(header)
+        self.columns: Dict[str, int] = {}
+        for index, column_name in enumerate(self.header):
+            # Keep the first occurrence of a duplicated header, like list.index did
+            if column_name and column_name not in self.columns:
+                self.columns[column_name] = index + 1
+
+    @staticmethod
+    def _strip(header: List[str]) -> List[str]:
+        # Padded reads add blank headers past the last named column, row_values(1) does not
+        header = list(header)
+        while header and header[-1] == "":
+            header.pop()
+        return header
+
+    def matches(self, header: List[str]) -> bool:
+        return self.header == self._strip(header)
+
+    def index(self, column_name: str) -> int:
+        try:
+            return self.columns[column_name]
+        except KeyError:
+            raise ValueError(f"{column_name} is not in the header row")
 
 
 class GoogleSheetClient:
-    def __init__(self, credentials_file, spreadsheet_name, logger: logging.Logger):
+    def __init__(
+        self,
+        credentials_file,
+        spreadsheet_name,
+        logger: logging.Logger,
+        mirror_path: str = None,
+        quota_state_path: str = None,
+        requests_per_minute: int = 60
+    ):
         self.credentials_file = credentials_file
         self.spreadsheet_name = spreadsheet_name
         self.client: Union[None, gspread.Client] = None
+        self.spreadsheet: Union[None, gspread.Spreadsheet] = None
         self.sheet: Union[None, gspread.Worksheet] = None
         self.logger = logger
 
+        # Worksheet handles and header schemas, keyed by worksheet title
+        self.worksheets: Dict[str, gspread.Worksheet] = {}
+        self.schemas: Dict[str, SheetSchema] = {}
+
+        # Optional local SQLite mirror that read_records() is served from
+        self.mirror: Union[None, SheetMirror] = SheetMirror(mirror_path, logger) if mirror_path else None
+
+        # Scripts sharing a credentials file share its quota, so by default they share the limiter state next to it
+        if quota_state_path is None:
+            quota_state_path = os.path.join(os.path.dirname(os.path.abspath(credentials_file)), ".sheets_quota")
+        self.executor = SheetsRequestExecutor(quota_state_path, logger, requests_per_minute=requests_per_minute)
+
         # Define the scope of the application
         scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
 
@@ -932,31 +1501,166 @@ class GoogleSheetClient:
         # Authenticate and create a client
         self.client = gspread.authorize(credentials)
 
-    # Function to perform API requests with exponential backoff
-    def _perform_request_with_backoff(self, func, *args, **kwargs):
-        max_retries = 5
-        for retry in range(max_retries):
-            try:
-                return func(*args, **kwargs)
-            except gspread.exceptions.APIError as e:
-                if "Rate Limit Exceeded" in str(e):
-                    wait_time = (2 ** retry) * 0.5  # Exponential backoff
-                    self.logger.warning(f"Rate limit exceeded. Waiting for {wait_time} seconds before retrying...")
-                    time.sleep(wait_time)
-                else:
-                    raise e  # Re-raise if it's not a rate limit error
-        raise Exception("Max retries exceeded")
+    def execute(self, func, *args, **kwargs):
+        """Every Sheets API call goes through the shared quota-aware executor"""
+        return self.executor.execute(func, *args, **kwargs)
 
     def open_sheet(self, sheet_name):
-        self.sheet = self.client.open(self.spreadsheet_name).worksheet(sheet_name)
+        if self.spreadsheet is None:
+            self.spreadsheet = self.execute(self.client.open, self.spreadsheet_name)
+
+        if sheet_name not in self.worksheets:
+            self.worksheets[sheet_name] = self.execute(self.spreadsheet.worksheet, sheet_name)
+
+        self.sheet = self.worksheets[sheet_name]
+
+    @property
+    def schema(self) -> SheetSchema:
+        """The cached header schema of the open worksheet, loaded on first use"""
+        if self.sheet is None:
+            raise Exception("Sheet not opened. Please call open_sheet() method first.")
+
+        if self.sheet.title not in self.schemas:
+            # assuming the first row contains headers
+            header = self.execute(self.sheet.row_values, 1)
+            self.schemas[self.sheet.title] = SheetSchema(header)
+
+        return self.schemas[self.sheet.title]
+
+    @property
+    def columns(self) -> Dict[str, int]:
+        """Mapping of every header in the open worksheet to its 1-based column index"""
+        return self.schema.columns
+
+    def invalidate_schema(self, sheet_name: str = None):
+        """Drops the cached header schema so it is reloaded on next use"""
+        self.schemas.pop(sheet_name or self.sheet.title, None)
+
+    def _check_header(self, header: List[str]):
+        # Cached schemas are dropped whenever a read shows the header row has changed
+        schema = self.schemas.get(self.sheet.title)
+        if schema is not None and header and not schema.matches(header):
+            self.logger.info(f"Header row of {self.sheet.title} changed, reloading schema")
+            self.schemas[self.sheet.title] = SheetSchema(header)
 
     def read_records(self):
         # Read all records from the sheet
         if self.sheet is not None:
-            return self._perform_request_with_backoff(self.sheet.get_all_records)
+            if self.mirror is not None:
+                return self._read_records_from_mirror()
+
+            records = self.execute(self.sheet.get_all_records)
+            if records:
+                self._check_header(list(records[0].keys()))
+
+            return records
         else:
             raise Exception("Sheet not opened. Please call open_sheet() method first.")
 
+    def read_frame(self) -> LeadFrame:
+        """
+        Read the open worksheet into a columnar LeadFrame, served from the mirror when there is one.
+
+        :return: The frame, row index 0 being the first row after the header.
+        """
+        if self.sheet is None:
+            raise Exception("Sheet not opened. Please call open_sheet() method first.")
+
+        if self.mirror is not None:
+            self._sync_mirror()
+            return LeadFrame.from_values(self.mirror.values(self.sheet.title))
+
+        values = self.execute(self.sheet.get_all_values)
+        if values:
+            self._check_header(values[0])
+
+        return LeadFrame.from_values(values)
+
+    def _read_records_from_mirror(self):
+        """Serve records from the local mirror, see _sync_mirror()"""
+        self._sync_mirror()
+
+        return self.mirror.records(self.sheet.title)
+
+    def _sync_mirror(self):
+        """
+        Syncs the mirror of the open worksheet, only if the spreadsheet was modified since the last sync.
+
+        The check is spreadsheet wide, any write to another tab also triggers a full fetch of this one. A cheaper per
+        tab check such as the row count plus the last row would miss edits to earlier rows (sent stamps), so it is not
+        used; see SheetMirror.
+        """
+        modified_time = self.execute(self.spreadsheet.get_lastUpdateTime)
+        if not self.mirror.is_current(self.sheet.title, modified_time):
+            values = self.execute(self.sheet.get_all_values)
+            self.mirror.sync(self.sheet.title, values, modified_time)
+            if values:
+                self._check_header(values[0])
+        else:
+            self.logger.info(f"Mirror of {self.sheet.title} is current, skipping fetch")
+
+    def read_columns(self, column_names: List[str], chunk_rows: int = 5000, start_row: int = 2):
+        """
+        Read only the given columns of the open worksheet, fetching chunk_rows rows at a time with one batch_get.
+
+        Every row from start_row up to the last row with a value in any of the requested columns is yielded in sheet
+        order, blank rows in between included, with values numericised the same way read_records() does. Reading goes
+        on to the end of the grid, so blank stretches (even whole chunks) do not end it early.
+
+        :param column_names: The headers of the columns to read.
+        :param chunk_rows: How many rows to fetch per request.
+        :param start_row: The 1-based row to start reading from, defaults to the first row after the header.
+        :return: A generator of (row_num, row) pairs, row being a dictionary keyed by the requested column names.
+        """
+        col_nums = [self.get_column_index(column_name) for column_name in column_names]
+        # Other scripts append rows, the grid may have grown since the worksheet was opened
+        self.refresh_sheet()
+
+        blank_rows = []
+        while start_row <= self.sheet.row_count:
+            end_row = min(start_row + chunk_rows - 1, self.sheet.row_count)
+            ranges = [f"{rowcol_to_a1(start_row, col_num)}:{rowcol_to_a1(end_row, col_num)}" for col_num in col_nums]
+            value_ranges = self.execute(self.sheet.batch_get, ranges, major_dimension=Dimension.cols)
+
+            # With column major ranges every value range holds at most one list, trailing blanks are left out
+            columns = [value_range[0] if value_range else [] for value_range in value_ranges]
+            chunk_length = max([len(column) for column in columns], default=0)
+
+            for offset in range(chunk_length):
+                row = [column[offset] if offset < len(column) else "" for column in columns]
+                if not any(row):
+                    # Blank rows are held back until a later row shows they are not past the end of the data
+                    blank_rows.append(start_row + offset)
+                    continue
+
+                for blank_row in blank_rows:
+                    yield blank_row, dict.fromkeys(column_names, "")
+                blank_rows = []
+                yield start_row + offset, dict(zip(column_names, numericise_all(row)))
+
+            blank_rows.extend(range(start_row + chunk_length, end_row + 1))
+            start_row = end_row + 1
+
+    def refresh_sheet(self):
+        """Reloads the properties (grid size) of the open worksheet"""
+        self.sheet = self.execute(self.spreadsheet.get_worksheet_by_id, self.sheet.id)
+        self.worksheets[self.sheet.title] = self.sheet
+
+    def get_last_used_row(self, start_row: int = 1) -> int:
+        """
+        Find the last row with a value in any column of the open worksheet.
+
+        Only rows from start_row on are fetched, so passing a row known to be in use keeps this cheap.
+
+        :param start_row: The 1-based row to look from.
+        :return: The 1-based number of the last used row, or start_row - 1 if no row from start_row on is used.
+        """
+        last_col = rowcol_to_a1(1, max(self.sheet.col_count, 1)).rstrip("0123456789")
+        # The range is open ended so rows added since the worksheet was opened are included, trailing blanks are left out
+        values = self.execute(self.sheet.get, f"A{start_row}:{last_col}")
+
+        return start_row - 1 + len(values)
+
     def get_column_index(self, column_name):
         """
         Retrieve the column index for a given column name based on the first row.
@@ -964,27 +1668,267 @@ class GoogleSheetClient:
         :param column_name: The name of the column to find.
         :return: The 1-based index of the column.
         """
-        row_values = self._perform_request_with_backoff(self.sheet.row_values, 1)  # assuming the first row contains headers
-        return row_values.index(column_name) + 1
+        if column_name not in self.columns:
+            # The header may have been edited since the schema was cached
+            self.invalidate_schema()
+
+        return self.schema.index(column_name)
 
     def get_last_row(self):
-        return len(self._perform_request_with_backoff(self.sheet.get_all_records)) + 2
+        return len(self.read_records()) + 2
 
     def update_cell(self, row_number, column_index, value):
-        self._perform_request_with_backoff(self.sheet.update_cell, row_number, column_index, value)
+        self.execute(self.sheet.update_cell, row_number, column_index, value)
+
+    def update(self, values: List[list], range_name: str):
+        """Writes a block of values to the open worksheet starting at range_name"""
+        return self.execute(self.sheet.update, values, range_name)
+
+    def writer(
+        self,
+        max_cells: int = 5000,
+        flush_interval: float = 30,
+        raw: bool = True,
+        max_rows: int = None
+    ) -> SheetWriteBuffer:
+        """
+        Create a buffered writer for the currently open worksheet.
+
+        :param max_cells: Number of staged cells that triggers a flush.
+        :param flush_interval: Seconds after the first unflushed write before a timed flush, 0 to disable.
+        :param raw: Write values as-is instead of parsing them as if typed into the UI.
+        :param max_rows: Number of rows with staged cells that triggers a flush, None for no row limit.
+        :return: A SheetWriteBuffer bound to the current worksheet, to be used as a context manager.
+        """
+        if self.sheet is None:
+            raise Exception("Sheet not opened. Please call open_sheet() method first.")
+
+        return SheetWriteBuffer(
+            self, self.sheet, max_cells=max_cells, flush_interval=flush_interval, raw=raw, max_rows=max_rows
+        )
+
+
+_config_cache: Dict[str, Tuple[float, dict]] = {}
+_config_lock = threading.Lock()
+
+
+def load_config(config_file_name: str) -> dict:
+    """
+    Load a JSON config file, reusing the parsed copy until the file changes on disk.
+
+    :param config_file_name: Path to the config file.
+    :return: The parsed config. It is shared between callers and must not be modified.
+    """
+    modified_time = os.path.getmtime(config_file_name)
+    with _config_lock:
+        cached = _config_cache.get(config_file_name)
+        if cached is not None and cached[0] == modified_time:
+            return cached[1]
+
+        with open(config_file_name, 'rb') as config_file:
+            config = json.load(config_file)
+        _config_cache[config_file_name] = (modified_time, config)
+
+    return config
+
+
+class HttpTransport:
+    """
+    Shared HTTP layer for the REST clients (BatchData, DealMachine and the local SMS queue API).
+
+    One pooled keep-alive Session is kept per host. Every request gets a default timeout, idempotent requests are
+    retried with exponential backoff on connection errors and throttled or 5xx responses (honouring Retry-After), and
+    the count, errors and latency of every endpoint are recorded. Non-idempotent requests such as POSTs are never
+    retried here, since a repeated skip trace or SMS enqueue is not free.
+
+    requests only speaks HTTP/1.1, so the tuning surface is connection reuse: pool sizes per host and keep_alive=False
+    to send "Connection: close" for servers that drop idle connections badly. pool_maxsize is only the default, clients
+    running concurrent workers against a host raise its pool to their worker count with ensure_pool_size().
+    """
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+    _shared: Union[None, "HttpTransport"] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        timeout: float = 30,
+        max_retries: int = 4,
+        backoff_factor: float = 0.5,
+        pool_maxsize: int = 10,
+        keep_alive: bool = True
+    ):
+        self.logger = logger
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, requests.Session] = {}
+        self.pool_sizes: Dict[str, int] = {}
+        self.metrics: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+
+    @classmethod
+    def shared(cls, logger: logging.Logger) -> "HttpTransport":
+        """The process-wide transport used by clients that were not given one"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(logger)
+            return cls._shared
+
+    @staticmethod
+    def _host(url: str) -> str:
+        parts = urllib.parse.urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _mount_adapter(self, session: requests.Session, host: str):
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRYABLE_STATUS_CODES,
+            allowed_methods=self.IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_sizes.get(host, self.pool_maxsize), max_retries=retry
+        )
+        session.mount(f"{urllib.parse.urlsplit(host).scheme}://", adapter)
+
+    def ensure_pool_size(self, url: str, size: int):
+        """
+        Make the connection pool for the host of the given url hold at least size connections.
+
+        Connections past the pool size are opened anyway but discarded after use ("Connection pool is full"), so
+        clients call this with the number of workers they run against the host.
+
+        :param url: Any url on the host.
+        :param size: The number of requests that may be in flight at once.
+        """
+        host = self._host(url)
+        with self.lock:
+            if size <= self.pool_sizes.get(host, self.pool_maxsize):
+                return
+
+            self.pool_sizes[host] = size
+            session = self.sessions.get(host)
+            if session is not None:
+                # Requests in flight finish on the old pool, new ones use the larger one
+                self._mount_adapter(session, host)
+
+    def session(self, url: str) -> requests.Session:
+        """Returns the pooled session for the host of the given url, creating it on first use"""
+        host = self._host(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self._mount_adapter(session, host)
+                if not self.keep_alive:
+                    session.headers["Connection"] = "close"
+                self.sessions[host] = session
+
+        return session
+
+    def request(self, method: str, url: str, endpoint: str = None, **kwargs) -> requests.Response:
+        """
+        Send a request over the pooled session for its host.
+
+        :param method: The HTTP method.
+        :param url: The full url, without query string (pass params instead).
+        :param endpoint: Name to record metrics under, defaults to the method and url.
+        :param kwargs: Passed on to requests, timeout defaults to the transport timeout.
+        :return: The response. Error statuses are returned, not raised.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = endpoint or f"{method.upper()} {url}"
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session(url).request(method, url, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            self._record(endpoint, time.perf_counter() - start, failed)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def _record(self, endpoint: str, seconds: float, failed: bool):
+        with self.lock:
+            metric = self.metrics[endpoint]
+            metric["count"] += 1
+            metric["errors"] += failed
+            metric["total_seconds"] += seconds
+            metric["max_seconds"] = max(metric["max_seconds"], seconds)
+
+    def log_metrics(self):
+        """Logs request count, errors and latency per endpoint"""
+        with self.lock:
+            metrics = {endpoint: dict(metric) for endpoint, metric in self.metrics.items()}
+
+        for endpoint, metric in sorted(metrics.items()):
+            average = metric["total_seconds"] / metric["count"]
+            self.logger.info(
+                f"{endpoint}: {metric['count']} requests, {metric['errors']} errors, "
+                f"avg {round(average * 1000)} ms, max {round(metric['max_seconds'] * 1000)} ms"
+            )
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
 
 
 class BatchDataClient:
     BASE_URL = "https://api.batchdata.com/api/v1"
 
-    def __init__(self, logger, config_file_name: str = "config.json"):
+    def __init__(
+        self,
+        logger,
+        config_file_name: str = "config.json",
+        cache_path: str = None,
+        transport: HttpTransport = None,
+        timeout: float = 120
+    ):
         self.config_file_name = config_file_name
         self.logger = logger
+        self.transport = transport or HttpTransport.shared(logger)
+        # A full batch of skip traces can take well over the default timeout to come back
+        self.timeout = timeout
+
+        # Results are cached by normalized contact address and name when a cache path is given
+        self.cache_path = cache_path
+        self.cache: Union[None, SkipTraceCache] = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Leads actually sent to BatchData by skip_trace_many, and the account-wide error that stopped it if any
+        self.traced_count = 0
+        self.last_error: Union[None, BatchAPIError] = None
+        self.rate_limiter = RateLimiter()
 
     def __enter__(self):
         # Load the config file on context entry
-        with open(self.config_file_name, 'rb') as config_file:
-            self.config = json.load(config_file)
+        self.config = load_config(self.config_file_name)
+
+        if self.cache_path:
+            self.cache = SkipTraceCache(
+                self.cache_path,
+                ttl_days=self.config.get("skip_trace_cache_ttl_days", 180),
+                empty_ttl_days=self.config.get("skip_trace_cache_empty_ttl_days", 7)
+            )
 
         return self
 
@@ -994,12 +1938,39 @@ class BatchDataClient:
         if exc_type:
             self.logger.error(f"An error occurred: {exc_value}")
 
+        if self.cache is not None:
+            self.logger.info(f"Skip trace cache hits: {self.cache_hits}, misses: {self.cache_misses}")
+            self.cache.close()
+            self.cache = None
+
+    @staticmethod
+    def cache_key(city: str, street: str, state: str, zipcode: str, first_name: str = "", last_name: str = "") -> str:
+        name = " ".join(f"{first_name} {last_name}".lower().split())
+        return f"{normalize_address_key(street, city, state, zipcode)}|{name}"
+
+    def _cached(self, key: str) -> Union[None, List[str]]:
+        if self.cache is None:
+            return None
+
+        phone_numbers = self.cache.get(key)
+        if phone_numbers is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+
+        return phone_numbers
+
     def _get_headers(self):
         return {
             "Authorization": f"Bearer {self.config['batch_data_api_key']}"
         }
 
     def skip_trace(self, city: str, street: str, state: str, zipcode: str, first_name: str = "", last_name: str = "", num_phones: int = 3):
+        key = self.cache_key(city, street, state, zipcode, first_name, last_name)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
         headers = self._get_headers()
         body = {
             "requests": [
@@ -1022,7 +1993,9 @@ class BatchDataClient:
 
         phone_numbers = []
         try:
-            response = requests.post(f"{self.BASE_URL}/property/skip-trace", json=body, headers=headers).json()
+            response = self.transport.post(
+                f"{self.BASE_URL}/property/skip-trace", json=body, headers=headers, timeout=self.timeout
+            ).json()
 
             if response['status']['code'] != 200:
                 raise BatchAPIError(response['status']['message'])
@@ -1035,24 +2008,225 @@ class BatchDataClient:
                     mobile_numbers = [num["number"] for num in phones_list if num["type"] == "Mobile"]
                     phone_numbers.extend(mobile_numbers[:num_phones])
 
+            if self.cache is not None:
+                self.cache.put(key, phone_numbers)
         except (KeyError, IndexError) as e:
             self.logger.error(e, exc_info=True)
             self.logger.error(f"Errored on: {street} {city} {state} {zipcode}", exc_info=True)
 
         return phone_numbers
 
+    @staticmethod
+    def _mobile_numbers(people: List[dict], num_phones: int) -> List[str]:
+        phone_numbers = []
+        for person in people:
+            if person and not person.get("death", {}).get("deceased", False):
+                phones_list = person.get("phoneNumbers", [])
+                mobile_numbers = [num["number"] for num in phones_list if num["type"] == "Mobile"]
+                phone_numbers.extend(mobile_numbers[:num_phones])
+
+        return phone_numbers
+
+    @staticmethod
+    def _address_key(address: dict) -> str:
+        return normalize_address_key(address.get("street"), address.get("city"), address.get("state"), address.get("zip"))
+
+    def _skip_trace_batch(self, leads: List[dict], num_phones: int) -> List[dict]:
+        """
+        Skip trace one batch of leads in a single request, splitting the batch when the API rejects it as malformed so
+        a single bad address only fails itself.
+        """
+        body = {"requests": []}
+        for index, lead in enumerate(leads):
+            request = {
+                "requestId": str(index),
+                "propertyAddress": {
+                    "city": lead["city"],
+                    "street": lead["street"],
+                    "state": lead["state"],
+                    "zip": lead["zipcode"]
+                }
+            }
+            if lead.get("first_name") and lead.get("last_name"):
+                request["name"] = {
+                    "first": lead["first_name"],
+                    "last": lead["last_name"]
+                }
+            body["requests"].append(request)
+
+        self.rate_limiter.acquire()
+        response = self.transport.post(
+            f"{self.BASE_URL}/property/skip-trace", json=body, headers=self._get_headers(), timeout=self.timeout
+        ).json()
+
+        status = response.get("status", {})
+        if status.get("code") == 400 and len(leads) > 1:
+            # The halves are billed separately, an account-wide error on one must not throw away the other's results
+            middle = len(leads) // 2
+            results = []
+            for half in (leads[:middle], leads[middle:]):
+                if self.last_error is not None:
+                    results.extend(self._stopped_results(len(half)))
+                    continue
+                try:
+                    results.extend(self._skip_trace_batch(half, num_phones))
+                except BatchAPIError as e:
+                    self._stop(e)
+                    results.extend(self._stopped_results(len(half)))
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    self.logger.error(f"Skip trace of {len(half)} leads failed, will retry: {e}")
+                    results.extend({"phone_numbers": [], "error": str(e), "retry": True} for _ in half)
+            return results
+        elif status.get("code") == 400:
+            return [{"phone_numbers": [], "error": status.get("message", "Bad request"), "retry": False}]
+        elif status.get("code") != 200:
+            raise BatchAPIError(status.get("message", response))
+
+        # Persons are matched back to their request by the echoed request id, falling back to the property address
+        people_by_request = defaultdict(list)
+        request_ids_by_address = {
+            self._address_key(request["propertyAddress"]): request["requestId"] for request in body["requests"]
+        }
+        for person in response.get("results", {}).get("persons", []):
+            if not person:
+                continue
+
+            request_id = person.get("request", {}).get("requestId")
+            if request_id is None:
+                request_id = request_ids_by_address.get(self._address_key(person.get("propertyAddress", {})))
+            people_by_request[request_id].append(person)
+
+        results = []
+        for request in body["requests"]:
+            try:
+                phone_numbers = self._mobile_numbers(people_by_request[request["requestId"]], num_phones)
+                results.append({"phone_numbers": phone_numbers, "error": None, "retry": False})
+            except (KeyError, IndexError, TypeError) as e:
+                results.append({"phone_numbers": [], "error": str(e), "retry": False})
+
+        return results
+
+    def _stop(self, error: BatchAPIError):
+        if self.last_error is None:
+            self.logger.warning(f"Skip tracing stopped: {error}")
+        self.last_error = error
+
+    def _stopped_results(self, count: int) -> List[dict]:
+        """Results for leads not traced because an account-wide error stopped skip tracing"""
+        return [{"phone_numbers": [], "error": str(self.last_error), "retry": True} for _ in range(count)]
+
+    def skip_trace_many(
+        self,
+        leads: List[dict],
+        batch_size: int = 100,
+        num_phones: int = 3,
+        workers: int = 1,
+        requests_per_second: float = None,
+        limit: int = None
+    ) -> List[Union[None, dict]]:
+        """
+        Skip trace many leads, packing up to batch_size property addresses into each request.
+
+        Batches are sent from a pool of workers, spaced out to at most requests_per_second requests. Cached leads
+        never reach the network and do not count towards limit.
+
+        :param leads: Dictionaries with city, street, state and zipcode keys, and optionally first_name and last_name.
+        :param batch_size: How many addresses to send per request.
+        :param num_phones: Maximum number of mobile numbers to keep per person.
+        :param workers: How many batches may be in flight at once.
+        :param requests_per_second: Maximum request rate, unlimited if not given.
+        :param limit: Maximum number of uncached leads to send, in input order.
+        :return: One {"phone_numbers": [...], "error": None or str, "retry": bool} dictionary per lead, in input
+            order, or None for leads past limit. An address the API rejects gets an error instead of failing its batch.
+            Leads in a batch that failed on an error affecting the whole account (such as billing), or left over after
+            it stopped the run, get that error with retry set, they were not traced and can be sent again later. The
+            error is also kept in last_error. Results of the batches that went through are always returned.
+        """
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.last_error = None
+        self.transport.ensure_pool_size(self.BASE_URL, workers)
+
+        # Cached leads never reach the network, only the rest are batched
+        results: List[Union[None, dict]] = [None] * len(leads)
+        keys = []
+        to_fetch = []
+        for index, lead in enumerate(leads):
+            key = self.cache_key(
+                lead["city"], lead["street"], lead["state"], lead["zipcode"],
+                lead.get("first_name", ""), lead.get("last_name", "")
+            )
+            keys.append(key)
+            cached = self._cached(key)
+            if cached is not None:
+                results[index] = {"phone_numbers": cached, "error": None, "retry": False}
+            else:
+                to_fetch.append(index)
+
+        if limit is not None:
+            to_fetch = to_fetch[:limit]
+
+        def trace_batch(batch_indexes: List[int]) -> List[dict]:
+            if self.last_error is not None:
+                return self._stopped_results(len(batch_indexes))
+
+            try:
+                batch_results = self._skip_trace_batch([leads[index] for index in batch_indexes], num_phones)
+            except BatchAPIError as e:
+                self._stop(e)
+                return self._stopped_results(len(batch_indexes))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # Timeouts, dropped connections and non-JSON bodies (e.g. a 502 page) never reached the API, so
+                # these leads are retried on the next run instead of being counted as traced
+                self.logger.error(f"Skip trace batch of {len(batch_indexes)} leads failed, will retry: {e}")
+                batch_results = [{"phone_numbers": [], "error": str(e), "retry": True} for _ in batch_indexes]
+            except Exception as e:
+                # Any other failure only fails its own batch, results of the other batches are kept
+                self.logger.error(f"Skip trace batch of {len(batch_indexes)} leads failed: {e}", exc_info=True)
+                batch_results = [{"phone_numbers": [], "error": str(e), "retry": False} for _ in batch_indexes]
+
+            return batch_results
+
+        batches = [to_fetch[start:start + batch_size] for start in range(0, len(to_fetch), batch_size)]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for batch_indexes, batch_results in zip(batches, executor.map(trace_batch, batches)):
+                self.traced_count += len([result for result in batch_results if not result["retry"]])
+                for index, result in zip(batch_indexes, batch_results):
+                    results[index] = result
+                    if self.cache is not None and not result["error"]:
+                        self.cache.put(keys[index], result["phone_numbers"])
+
+        return results
+
 
 class DealMachineClient:
     BASE_URL = "https://api.dealmachine.com/public/v1"
+    PAGE_SIZE = 100
 
-    def __init__(self, logger, config_file_name: str = "config.json"):
+    def __init__(
+        self,
+        logger,
+        config_file_name: str = "config.json",
+        sync_state_path: str = None,
+        full_resync_days: int = 7,
+        concurrency: int = 4,
+        transport: HttpTransport = None
+    ):
         self.config_file_name = config_file_name
         self.logger = logger
 
+        # Pages are fetched concurrently over the pooled keep-alive session of the transport
+        self.concurrency = concurrency
+        self.transport = transport or HttpTransport.shared(logger)
+        self.transport.ensure_pool_size(self.BASE_URL, concurrency)
+
+        # Incremental sync remembers the last page read and its lead ids, see get_leads()
+        self.sync_state_path = sync_state_path
+        self.full_resync_days = full_resync_days
+        self.pending_sync_state: Union[None, dict] = None
+
     def __enter__(self):
         # Load the config file on context entry
-        with open(self.config_file_name, 'rb') as config_file:
-            self.config = json.load(config_file)
+        self.config = load_config(self.config_file_name)
 
         return self
 
@@ -1067,32 +2241,285 @@ class DealMachineClient:
             "Authorization": f"Bearer {self.config['deal_machine_api_key']}"
         }
 
-    def get_leads(self):
-        headers = self._get_headers()
+    def _get_page(self, headers: dict, after: int) -> List[dict]:
+        """Fetches one page of leads, the transport retries connection errors, timeouts and throttled or 5xx responses"""
+        try:
+            response = self.transport.get(
+                f"{self.BASE_URL}/leads/",
+                params={"limit": self.PAGE_SIZE, "after": after},
+                headers=headers
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Could not fetch DealMachine leads page at offset {after}: {e}")
+
+        return response.json()["data"]
+
+    def _iter_pages(self, headers: dict, after: int):
+        """
+        Yield (offset, page) pairs in order from the given offset until an empty page comes back.
+
+        Up to concurrency pages are in flight at once. Pages requested past the end of the account are cancelled or
+        discarded.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = {}
+            next_after = after
+            try:
+                while True:
+                    while len(in_flight) < self.concurrency:
+                        in_flight[next_after] = executor.submit(self._get_page, headers, next_after)
+                        next_after += self.PAGE_SIZE
+
+                    data = in_flight.pop(after).result()
+                    if not data:
+                        break
+
+                    yield after, data
+                    after += self.PAGE_SIZE
+            finally:
+                for future in in_flight.values():
+                    future.cancel()
+
+    def _load_sync_state(self) -> dict:
+        if not self.sync_state_path or not os.path.exists(self.sync_state_path):
+            return {}
+
+        with open(self.sync_state_path, 'rb') as sync_state_file:
+            return json.load(sync_state_file)
+
+    def save_sync_state(self):
+        """Persists the high-water mark of the last get_leads() call, to be called once its leads are stored"""
+        if self.sync_state_path and self.pending_sync_state:
+            with open(self.sync_state_path, 'w') as sync_state_file:
+                json.dump(self.pending_sync_state, sync_state_file)
+            self.pending_sync_state = None
+
+    def _resume_point(self, headers: dict, state: dict) -> Tuple[int, List[dict], set]:
+        """
+        Work out where an incremental sync can pick up from.
+
+        The page at the stored offset is fetched again and must still start with the stored lead ids, otherwise leads
+        were deleted or reordered and offsets can no longer be trusted.
+
+        :return: The offset to continue from, the re-fetched page and the ids on it that were already seen. An offset
+            of 0 with an empty page means a full resync is needed.
+        """
+        if not state:
+            return 0, [], set()
+
+        last_full_sync = datetime.fromisoformat(state["last_full_sync"])
+        if datetime.now() - last_full_sync > timedelta(days=self.full_resync_days):
+            self.logger.info(f"Last full DealMachine sync was {last_full_sync}, doing a full resync")
+            return 0, [], set()
+
+        page = self._get_page(headers, state["last_page_after"])
+        page_ids = [batch_lead.get("id") for batch_lead in page]
+        if not state["last_page_ids"] or page_ids[:len(state["last_page_ids"])] != state["last_page_ids"]:
+            self.logger.info("DealMachine leads changed before the high-water mark, doing a full resync")
+            return 0, [], set()
+
+        return state["last_page_after"], page, set(state["last_page_ids"])
+
+    def _parse_leads(self, batch_leads: List[Tuple[dict, bool]]) -> List[dict]:
+        """Parses both addresses of every lead in one batch"""
+        raw_addresses = []
+        for batch_lead, _ in batch_leads:
+            raw_addresses.extend([batch_lead["owner_address_full"], batch_lead["property_address_full"]])
+        addresses = parse_addresses(raw_addresses)
+
         leads = []
+        for index, (batch_lead, is_rd4d) in enumerate(batch_leads):
+            contact_address = addresses[index * 2]
+            target_address = addresses[index * 2 + 1]
+            if target_address is None:
+                self.logger.warning(f"Could not parse property address \"{batch_lead['property_address_full']}\"")
+                continue
+
+            lead = {
+                "creator": batch_lead["creator"]["label"],
+                "type": "RD4D" if is_rd4d else "D4D",
+                "contact_address": contact_address if contact_address is not None and contact_address.is_valid else target_address,
+                "target_address": target_address
+            }
+            leads.append(lead)
 
-        data = None
-        after = 0
-        while data is None or data != []:
-            response = requests.get(f"{self.BASE_URL}/leads/?limit=100&after={after}", headers=headers)
-            data = response.json()["data"]
+        return leads
+
+    def iter_leads(self, incremental: bool = False, parse_batch_size: int = 500):
+        """
+        Stream D4D and RD4D leads from DealMachine as pages come in.
+
+        Leads are parsed in batches of parse_batch_size while later pages are still being fetched, so the first leads
+        are available long before the whole account has been read.
+
+        In incremental mode only pages past the stored high-water mark are fetched. Leads changed before the mark are
+        picked up by the full resync that runs every full_resync_days, or whenever the mark no longer lines up. Once the
+        generator is exhausted, call save_sync_state() after the leads have been stored to move the mark forward.
+
+        :param incremental: Resume from the persisted high-water mark instead of paging through the whole account.
+        :param parse_batch_size: How many leads to collect before their addresses are parsed and yielded.
+        :return: A generator of lead dictionaries with parsed addresses.
+        """
+        headers = self._get_headers()
+        batch_leads = []
+
+        state = self._load_sync_state() if incremental else {}
+        after, data, seen_ids = self._resume_point(headers, state)
+        full_sync = not data
+        last_page_after, last_page_ids = after, [batch_lead.get("id") for batch_lead in data]
+        if full_sync:
+            pages = self._iter_pages(headers, after)
+        else:
+            self.logger.info(f"Resuming DealMachine sync from offset {after}")
+            pages = itertools.chain([(after, data)], self._iter_pages(headers, after + self.PAGE_SIZE))
+
+        for page_after, data in pages:
+            last_page_after, last_page_ids = page_after, [batch_lead.get("id") for batch_lead in data]
 
             for batch_lead in data:
+                if batch_lead.get("id") in seen_ids:
+                    continue
+
                 is_rd4d = len([list_type for list_type in batch_lead["lists"] if list_type["title"] == "RD4D"]) > 0
                 is_d4d = not batch_lead["lists"]
                 if (is_rd4d or is_d4d) and "Edwin" not in batch_lead["creator"]["label"]:
-                    contact_address = Address(batch_lead["owner_address_full"])
-                    target_address = Address(batch_lead["property_address_full"])
-                    lead = {
-                        "creator": batch_lead["creator"]["label"],
-                        "type": "RD4D" if is_rd4d else "D4D",
-                        "contact_address": contact_address if contact_address.is_valid else target_address,
-                        "target_address": target_address
-                    }
-                    leads.append(lead)
+                    batch_leads.append((batch_lead, is_rd4d))
 
-            after += 100
-        return leads
+            if len(batch_leads) >= parse_batch_size:
+                yield from self._parse_leads(batch_leads)
+                batch_leads = []
+
+        yield from self._parse_leads(batch_leads)
+
+        self.pending_sync_state = {
+            "last_page_after": last_page_after,
+            "last_page_ids": last_page_ids,
+            "last_full_sync": datetime.now().isoformat() if full_sync else state["last_full_sync"]
+        }
+
+    def get_leads(self, incremental: bool = False):
+        """
+        Fetch D4D and RD4D leads from DealMachine, see iter_leads().
+
+        :param incremental: Resume from the persisted high-water mark instead of paging through the whole account.
+        :return: A list of lead dictionaries with parsed addresses.
+        """
+        return list(self.iter_leads(incremental=incremental))
+
+
+class SmsQueueClient:
+    """
+    Client for the local SMS queue API.
+
+    Payloads are sent in batches to the bulk endpoint, which takes {"messages": [...]} and answers with one
+    {"status": <code>, ...} entry per message in request order. When the server has no bulk endpoint (404/405) the
+    client falls back to posting messages one by one, with up to concurrency requests in flight.
+    """
+    HEADERS = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        base_url: str = "http://localhost:4723/api/v1",
+        transport: HttpTransport = None,
+        batch_size: int = 100,
+        concurrency: int = 8
+    ):
+        self.logger = logger
+        self.base_url = base_url
+        self.transport = transport or HttpTransport.shared(logger)
+        self.transport.ensure_pool_size(base_url, concurrency)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.bulk_supported = True
+
+    def enqueue(self, payload: dict) -> bool:
+        """
+        Queue a single message.
+
+        :param payload: The message with recipient, message and priority keys.
+        :return: True if the server accepted the message.
+        """
+        try:
+            response = self.transport.post(
+                f"{self.base_url}/sms/", headers=self.HEADERS, json=payload, endpoint="POST /api/v1/sms/"
+            )
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Failed to queue message for {payload['recipient']}: {e}")
+            return False
+
+        if response.status_code != 201:
+            self.logger.error(
+                f"Failed to queue message for {payload['recipient']}. "
+                f"Status code: {response.status_code}, Response: {response.text}"
+            )
+            return False
+
+        return True
+
+    def _enqueue_batch(self, payloads: List[dict]) -> Union[None, List[bool]]:
+        """Queues a batch through the bulk endpoint, returns None if the server does not have one"""
+        try:
+            response = self.transport.post(
+                f"{self.base_url}/sms/bulk/",
+                headers=self.HEADERS,
+                json={"messages": payloads},
+                endpoint="POST /api/v1/sms/bulk/"
+            )
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Failed to queue a batch of {len(payloads)} messages: {e}")
+            return [False] * len(payloads)
+
+        if response.status_code in (404, 405):
+            return None
+
+        try:
+            results = response.json()["results"]
+            if len(results) != len(payloads):
+                raise ValueError(f"expected {len(payloads)} results, got {len(results)}")
+        except (KeyError, ValueError) as e:
+            self.logger.error(
+                f"Failed to queue a batch of {len(payloads)} messages. "
+                f"Status code: {response.status_code}, Response: {response.text} ({e})"
+            )
+            return [False] * len(payloads)
+
+        accepted = []
+        for payload, result in zip(payloads, results):
+            accepted.append(result.get("status") == 201)
+            if not accepted[-1]:
+                self.logger.error(f"Failed to queue message for {payload['recipient']}: {result}")
+
+        return accepted
+
+    def enqueue_many(self, payloads: List[dict]) -> List[bool]:
+        """
+        Queue many messages at once.
+
+        :param payloads: The messages with recipient, message and priority keys.
+        :return: Whether each message was accepted, in input order.
+        """
+        accepted: List[bool] = []
+        start = 0
+        while self.bulk_supported and start < len(payloads):
+            batch_accepted = self._enqueue_batch(payloads[start:start + self.batch_size])
+            if batch_accepted is None:
+                self.logger.info("SMS queue API has no bulk endpoint, queuing messages one by one")
+                self.bulk_supported = False
+                break
+
+            accepted.extend(batch_accepted)
+            start += self.batch_size
+
+        if start < len(payloads):
+            with ThreadPoolExecutor(max_workers=max(self.concurrency, 1)) as executor:
+                accepted.extend(executor.map(self.enqueue, payloads[start:]))
+
+        return accepted
 
 
 async def test():
@@ -0,0 +1,133 @@
+import json
+import logging
+import sqlite3
+
+from helpers import normalize_address_key
+from typing import List
+
+
+class AddressIndex:
+    """
+    Set of normalized target address keys for every lead in Leads Master, shared by the importers.
+
+    The keys live in an in-memory set for constant-time lookups and are persisted to a SQLite file together with the
+    number of sheet rows they cover. On refresh only rows past that count are read from the sheet, and newly imported
+    keys are written incrementally when the importer commits. The index also keeps the last used row of the sheet
+    (in any column), which is where importers append.
+    """
+    COLUMNS = ["TargetStreet", "TargetCity", "TargetState", "TargetZip"]
+
+    def __init__(self, path: str, logger: logging.Logger):
+        self.logger = logger
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS address_keys (key TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """
+        )
+        self.conn.commit()
+
+        self.keys = {key for (key,) in self.conn.execute("SELECT key FROM address_keys")}
+        meta = dict(self.conn.execute("SELECT name, value FROM meta"))
+        self.row_count = meta.get("row_count", 0)
+        self.last_row = meta.get("last_row", self.row_count + 1)
+        self.last_fingerprint = meta.get("last_fingerprint") or None
+        self.pending: List[str] = []
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def next_row(self) -> int:
+        """The sheet row right after the last used row"""
+        return self.last_row + 1
+
+    @staticmethod
+    def _row_fingerprint(row: dict) -> str:
+        return json.dumps([str(row[column]) for column in AddressIndex.COLUMNS])
+
+    @staticmethod
+    def row_key(row: dict) -> str:
+        return normalize_address_key(row["TargetStreet"], row["TargetCity"], row["TargetState"], row["TargetZip"])
+
+    def refresh(self, sheet_client):
+        """
+        Bring the index up to date with the open Leads Master worksheet.
+
+        The last indexed row is read again along with any new rows. If it no longer holds the lead it held at the last
+        refresh, rows were deleted or moved since (possibly with new ones appended after), so the index is rebuilt from
+        scratch.
+
+        :param sheet_client: A GoogleSheetClient with Leads Master open.
+        """
+        if self.row_count:
+            rows = sheet_client.read_columns(self.COLUMNS, start_row=self.row_count + 1)
+            last_indexed = next(rows, None)
+            if last_indexed is not None and self._row_fingerprint(last_indexed[1]) == self.last_fingerprint:
+                added = self._index_rows(rows)
+                self._find_last_row(sheet_client)
+                self.logger.info(f"Address index refreshed with {added} new rows ({self.row_count} rows indexed)")
+                return
+
+            self.logger.info("Leads Master rows changed since the address index was built, rebuilding")
+
+        self.keys = set()
+        self.row_count = 0
+        self.last_fingerprint = None
+        with self.conn:
+            self.conn.execute("DELETE FROM address_keys")
+        added = self._index_rows(sheet_client.read_columns(self.COLUMNS))
+        self._find_last_row(sheet_client)
+        self.logger.info(f"Address index rebuilt from {added} rows")
+
+    def _index_rows(self, rows) -> int:
+        keys = []
+        added = 0
+        for row_num, row in rows:
+            added += 1
+            self.row_count = row_num - 1
+            self.last_fingerprint = self._row_fingerprint(row)
+            if row["TargetStreet"]:
+                keys.append(self.row_key(row))
+
+        self.keys.update(keys)
+        self._save(keys)
+
+        return added
+
+    def _find_last_row(self, sheet_client):
+        # Rows past the indexed ones may hold values in other columns, appending must not overwrite them
+        self.last_row = max(self.row_count + 1, sheet_client.get_last_used_row(self.row_count + 1))
+        self._save([])
+
+    def add(self, key: str):
+        """Marks a key as present, it is persisted on the next commit()"""
+        if key not in self.keys:
+            self.keys.add(key)
+            self.pending.append(key)
+
+    def commit(self, appended_rows: int):
+        """
+        Persist keys added since the last commit, once their rows have been written to the sheet.
+
+        :param appended_rows: How many rows were appended to the sheet, starting at next_row.
+        """
+        # The appended rows are indexed from the sheet on the next refresh, the keys are already in the set
+        self.last_row += appended_rows
+        self._save(self.pending)
+        self.pending = []
+
+    def _save(self, keys: List[str]):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO address_keys (key) VALUES (?)", [(key,) for key in keys])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                [("row_count", self.row_count), ("last_row", self.last_row), ("last_fingerprint", self.last_fingerprint or "")]
+            )
+
+    def close(self):
+        self.conn.close()
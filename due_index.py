@@ -0,0 +1,196 @@
+import datetime
+import heapq
+import json
+import logging
+import sqlite3
+
+from lead_frame import LeadFrame
+from typing import Dict, List, Tuple, Union
+
+SLOTS = (1, 2, 3)
+
+
+class DueIndex:
+    """
+    Next eligible send time of every lead and phone slot in Leads Master, kept as a min-heap.
+
+    A slot is eligible once its phone is present and not yet queued, and (past the first slot) the previous message
+    was sent at least the configured delay ago. Slots that can never become due on their own (no phone, already
+    queued, previous message not sent) have no entry at all.
+
+    The due times are persisted to a SQLite file together with a fingerprint of the columns they depend on, so a
+    refresh only re-evaluates leads whose phones, queued or sent stamps changed since the last run.
+    """
+    COLUMNS = [
+        "TargetStreet",
+        "ContactPhone1", "ContactPhone2", "ContactPhone3",
+        "SMS1QueuedDateTime", "SMS2QueuedDateTime", "SMS3QueuedDateTime",
+        "SMS1SentDateTime", "SMS2SentDateTime", "SMS3SentDateTime"
+    ]
+
+    def __init__(self, path: str, logger: logging.Logger):
+        self.logger = logger
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (row_num INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS due (
+                row_num INTEGER NOT NULL,
+                slot INTEGER NOT NULL,
+                due_at REAL NOT NULL,
+                PRIMARY KEY (row_num, slot)
+            );
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL NOT NULL);
+            """
+        )
+        self.conn.commit()
+
+        self.entries: Dict[Tuple[int, int], float] = {
+            (row_num, slot): due_at for row_num, slot, due_at in self.conn.execute("SELECT row_num, slot, due_at FROM due")
+        }
+        self.heap = [(due_at, row_num, slot) for (row_num, slot), due_at in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _due_times(self, frame: LeadFrame, index: int, delay: datetime.timedelta) -> Dict[int, float]:
+        """Works out the due time of every eligible slot of a lead"""
+        due_times = {}
+        for slot in SLOTS:
+            if frame.get(index, f"SMS{slot}QueuedDateTime") != "" or frame.get(index, f"ContactPhone{slot}") == "":
+                continue
+
+            if slot == 1:
+                due_times[slot] = 0.0
+                continue
+
+            previous_sent_key = f"SMS{slot - 1}SentDateTime"
+            if frame.get(index, previous_sent_key) == "":
+                continue
+
+            previous_sent_time = frame.parsed(index, previous_sent_key)
+            if previous_sent_time is None:
+                self.logger.error(f"Could not parse {previous_sent_key} in row number {index + 2}")
+                continue
+
+            due_times[slot] = (previous_sent_time + delay).timestamp()
+
+        return due_times
+
+    def refresh(self, frame: LeadFrame, delay_days: float) -> bool:
+        """
+        Bring the index up to date with Leads Master.
+
+        :param frame: Leads Master, as returned by read_frame().
+        :param delay_days: Days to wait after a message was sent before the next slot is due.
+        :return: False if Leads Master is missing a column the due times depend on, the index is left as it was.
+        """
+        if len(frame) == 0:
+            # Header only or no sheet content at all, nothing can be due
+            self.entries.clear()
+            self.heap = []
+            with self.conn:
+                self.conn.execute("DELETE FROM due")
+                self.conn.execute("DELETE FROM fingerprints")
+            self.logger.info("Leads Master has no leads, due index cleared")
+            return True
+
+        missing = [column for column in self.COLUMNS if column not in frame]
+        if missing:
+            self.logger.error(f"Leads Master is missing columns {', '.join(missing)}, due index not refreshed")
+            return False
+
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'delay_days'").fetchone()
+        if row is None or row[0] != delay_days:
+            if row is not None:
+                self.logger.info("Message delay changed since the due index was built, rebuilding")
+            with self.conn:
+                self.conn.execute("DELETE FROM fingerprints")
+                self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('delay_days', ?)", (delay_days,))
+
+        fingerprints = dict(self.conn.execute("SELECT row_num, fingerprint FROM fingerprints"))
+        delay = datetime.timedelta(days=delay_days)
+
+        # Leads outside the queue mask can have no due slot, the per-slot checks only run for the others
+        eligible = frame.queue_mask()
+
+        changed_fingerprints = []
+        removed = []
+        added = []
+        for index, values in enumerate(zip(*[frame.column(column) for column in self.COLUMNS])):
+            row_num = index + 2
+            fingerprint = json.dumps(values)
+            if fingerprints.get(row_num) == fingerprint:
+                continue
+
+            changed_fingerprints.append((row_num, fingerprint))
+            due_times = self._due_times(frame, index, delay) if eligible[index] else {}
+            for slot in SLOTS:
+                if slot in due_times:
+                    added.append((row_num, slot, due_times[slot]))
+                elif (row_num, slot) in self.entries:
+                    removed.append((row_num, slot))
+
+        last_row = len(frame) + 1
+        removed.extend(key for key in self.entries if key[0] > last_row)
+
+        for key in removed:
+            del self.entries[key]
+        for row_num, slot, due_at in added:
+            self.entries[(row_num, slot)] = due_at
+        # Superseded heap entries are skipped when popped, the heap is only rebuilt once they pile up
+        if len(self.heap) > 2 * len(self.entries) + 1000:
+            self.heap = [(due_at, row_num, slot) for (row_num, slot), due_at in self.entries.items()]
+            heapq.heapify(self.heap)
+        else:
+            for row_num, slot, due_at in added:
+                heapq.heappush(self.heap, (due_at, row_num, slot))
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM due WHERE row_num = ? AND slot = ?", removed)
+            self.conn.executemany("INSERT OR REPLACE INTO due (row_num, slot, due_at) VALUES (?, ?, ?)", added)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints (row_num, fingerprint) VALUES (?, ?)", changed_fingerprints
+            )
+            self.conn.execute("DELETE FROM fingerprints WHERE row_num > ?", (last_row,))
+
+        self.logger.info(
+            f"Due index refreshed: {len(changed_fingerprints)} leads re-evaluated, {len(self.entries)} slots pending"
+        )
+
+        return True
+
+    def pop_due(self, now: Union[None, datetime.datetime] = None) -> List[Tuple[int, int]]:
+        """
+        Take every slot that is due off the heap, earliest first.
+
+        Popped slots stay in the persisted index until remove() is called for them, so a slot that fails to queue is
+        due again next run.
+
+        :param now: The time to compare against, defaults to the current time.
+        :return: (row_num, slot) pairs.
+        """
+        now = (now or datetime.datetime.now()).timestamp()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_at, row_num, slot = heapq.heappop(self.heap)
+            if self.entries.get((row_num, slot)) == due_at:
+                due.append((row_num, slot))
+
+        return due
+
+    def remove(self, slots: List[Tuple[int, int]]):
+        """
+        Drop slots that have been queued.
+
+        :param slots: (row_num, slot) pairs.
+        """
+        for key in slots:
+            self.entries.pop(key, None)
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM due WHERE row_num = ? AND slot = ?", slots)
+
+    def close(self):
+        self.conn.close()
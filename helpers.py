@@ -1,7 +1,100 @@
+import atexit
+import datetime
+import functools
+import os
+import queue
+import re
+import threading
+import time
 import usaddress
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from storage import AddressParseCache
+from typing import Iterable, Iterator, List, Tuple, Union
+
+
+SHEET_DATETIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+_SHEET_DATETIME_PATTERN = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{1,2}):(\d{1,2})", re.ASCII)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_sheet_datetime(value: str) -> datetime.datetime:
+    """
+    Parse a timestamp in the sheets' "%m/%d/%Y %H:%M:%S" format, a drop-in for strptime with that format.
+
+    Zero-padded values are sliced at fixed offsets and unpadded ones go through a regular expression, anything else
+    falls back to strptime. Results are memoized since the same stamps repeat across rows.
+
+    :param value: The timestamp string.
+    :return: The naive datetime.
+    :raises ValueError: If the value is not in the format or is not a valid date and time.
+    """
+    if len(value) == 19 and value[2] == "/" and value[5] == "/" and value[10] == " " and value[13] == ":" and value[16] == ":":
+        fields = (value[6:10], value[0:2], value[3:5], value[11:13], value[14:16], value[17:19])
+        if all(field.isascii() and field.isdigit() for field in fields):
+            return datetime.datetime(*map(int, fields))
+
+    match = _SHEET_DATETIME_PATTERN.fullmatch(value)
+    if match is None:
+        # Rare shapes the pattern does not cover (extra whitespace, non-ASCII digits) are left to strptime itself
+        return datetime.datetime.strptime(value, SHEET_DATETIME_FORMAT)
+    month, day, year, hour, minute, second = map(int, match.groups())
+
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def parse_sheet_datetimes(values: Iterable[str]) -> List[Union[None, datetime.datetime]]:
+    """
+    Parse a whole column of sheet timestamps.
+
+    :param values: The cell values.
+    :return: A datetime per value in input order, None for blank or unparseable values.
+    """
+    parsed = {}
+    results = []
+    for value in values:
+        if value not in parsed:
+            try:
+                parsed[value] = parse_sheet_datetime(value) if value != "" else None
+            except (TypeError, ValueError):
+                parsed[value] = None
+        results.append(parsed[value])
+
+    return results
+
+
+def format_sheet_datetime(value: datetime.datetime) -> str:
+    """Format a datetime the way the sheets store timestamps, without going through strftime"""
+    return f"{value.month:02d}/{value.day:02d}/{value.year:04d} {value.hour:02d}:{value.minute:02d}:{value.second:02d}"
+
+
+def normalize_address_key(street: str, city: str, state: str, zipcode: str) -> str:
+    """
+    Build the canonical key used to tell whether two addresses are the same lead.
+
+    Case, punctuation and repeated whitespace are ignored, and zip codes are reduced to their first five digits with
+    leading zeros restored (the sheet numericises zip codes).
+    """
+    parts = []
+    for part in (street, city, state):
+        part = re.sub(r"[^a-z0-9 ]", " ", str(part or "").lower())
+        parts.append(" ".join(part.split()))
+
+    zipcode = str(zipcode or "").strip()[:5]
+    parts.append(zipcode.zfill(5) if zipcode.isdigit() else zipcode.lower())
+
+    return "|".join(parts)
+
 
 class Address:
+    """
+    Parsed US address as a small immutable-by-convention value object.
+
+    Parsing goes through parse_address_components(), so repeated addresses skip the usaddress CRF tagger.
+    """
+    __slots__ = ("full_address", "street_name", "city", "state", "zip")
+
     STREET_LABELS = [
         "AddressNumberPrefix",
         "AddressNumber",
@@ -21,41 +114,59 @@ class Address:
         "LandmarkName"
     ]
 
-    def __init__(self, full_address: str):
+    def __init__(self, full_address: str, components: Tuple[str, str, str, str] = None):
         self.full_address: str = full_address
-        self.street_name: str = ""
-        self.city: str = ""
-        self.state: str = ""
-        self.zip: str = ""
+        if components is None:
+            components = parse_address_components(full_address)
 
-        self._parse_address()
+        self.street_name, self.city, self.state, self.zip = components
 
     @property
     def is_valid(self):
         return self.street_name and self.city and self.state and self.zip
 
+    @property
+    def key(self) -> str:
+        return normalize_address_key(self.street_name, self.city, self.state, self.zip)
+
+    @property
+    def components(self) -> Tuple[str, str, str, str]:
+        return self.street_name, self.city, self.state, self.zip
+
     @staticmethod
     def _format_str(string: str):
         return string.strip().strip(",").title()
 
-    def _parse_address(self):
+    @classmethod
+    def _parse_address(cls, full_address: str) -> Tuple[str, str, str, str]:
+        """Runs the usaddress tagger and returns the (street_name, city, state, zip) components"""
         street_str = ""
-        parsed_address = usaddress.parse(self.full_address)
+        parsed_address = usaddress.parse(full_address)
 
         address_dict = {}
         for value, key in parsed_address:
             address_dict[key] = address_dict[key] + f" {value}" if address_dict.get(key) else value
 
-        for label in self.STREET_LABELS:
+        for label in cls.STREET_LABELS:
             try:
                 street_str += f"{address_dict[label].title()} "
             except KeyError:
                 pass
 
-        self.street_name = self._format_str(street_str)
-        self.city = self._format_str(address_dict.get("PlaceName"))
-        self.state = address_dict.get("StateName").upper()
-        self.zip = address_dict.get("ZipCode")
+        street_name = cls._format_str(street_str)
+        city = cls._format_str(address_dict.get("PlaceName"))
+        state = address_dict.get("StateName").upper()
+        zipcode = address_dict.get("ZipCode")
+
+        return street_name, city, state, zipcode
+
+    def __eq__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return self.components == other.components
+
+    def __hash__(self):
+        return hash(self.components)
 
     def __str__(self):
         return self.full_address
@@ -63,3 +174,210 @@ class Address:
     def __repr__(self):
         return self.full_address
 
+
+# On-disk store consulted when the in-process LRU misses, set with use_parse_cache()
+_parse_cache: Union[None, AddressParseCache] = None
+
+# In-process LRU of parsed components. It is a plain OrderedDict rather than functools.lru_cache so parse_addresses()
+# can look addresses up before dispatching them to the pool and store what the pool returns
+_PARSED_COMPONENTS_SIZE = 65536
+_parsed_components: "OrderedDict[str, Tuple[str, str, str, str]]" = OrderedDict()
+_parsed_components_lock = threading.Lock()
+
+
+def _get_parsed(full_address: str) -> Union[None, Tuple[str, str, str, str]]:
+    with _parsed_components_lock:
+        components = _parsed_components.get(full_address)
+        if components is not None:
+            _parsed_components.move_to_end(full_address)
+        return components
+
+
+def _put_parsed(full_address: str, components: Tuple[str, str, str, str]):
+    with _parsed_components_lock:
+        _parsed_components[full_address] = components
+        _parsed_components.move_to_end(full_address)
+        if len(_parsed_components) > _PARSED_COMPONENTS_SIZE:
+            _parsed_components.popitem(last=False)
+
+
+def clear_parsed_addresses():
+    """Empties the in-process LRU of parsed addresses, the on-disk cache is left alone"""
+    with _parsed_components_lock:
+        _parsed_components.clear()
+
+
+def use_parse_cache(parse_cache: Union[None, AddressParseCache]):
+    """
+    Back address parsing with a persistent cache. It is flushed when the interpreter exits.
+
+    :param parse_cache: The on-disk cache to use, or None to only cache in process.
+    """
+    global _parse_cache
+    _parse_cache = parse_cache
+    clear_parsed_addresses()
+    if parse_cache is not None:
+        atexit.register(parse_cache.close)
+
+
+def parse_address_components(full_address: str) -> Tuple[str, str, str, str]:
+    """
+    Parse a raw address string into (street_name, city, state, zip), memoized in process and on disk.
+
+    :param full_address: The raw address string.
+    :return: The parsed components.
+    """
+    components = _get_parsed(full_address)
+    if components is not None:
+        return components
+
+    if _parse_cache is not None:
+        components = _parse_cache.get(full_address)
+        if components is not None:
+            _put_parsed(full_address, components)
+            return components
+
+    components = Address._parse_address(full_address)
+
+    _put_parsed(full_address, components)
+    if _parse_cache is not None:
+        _parse_cache.put(full_address, components)
+
+    return components
+
+
+def _parse_or_none(full_address: str) -> Union[None, Tuple[str, str, str, str]]:
+    # Runs inside pool workers, an unparseable address must not take the whole chunk down with it
+    try:
+        return Address._parse_address(full_address)
+    except Exception:
+        return None
+
+
+def parse_addresses(
+    full_addresses: Iterable[str],
+    workers: int = None,
+    serial_threshold: int = 2000
+) -> List[Union[None, Address]]:
+    """
+    Parse many raw addresses at once, spreading the usaddress tagging over a process pool.
+
+    Cached addresses (in process or on disk) and duplicates are only parsed once. When fewer than serial_threshold
+    addresses are left to tag, or only one worker is available, the tagging runs serially since starting the pool would
+    cost more than it saves.
+
+    :param full_addresses: The raw address strings.
+    :param workers: Number of worker processes, defaults to the number of CPUs.
+    :param serial_threshold: Minimum number of addresses to tag before a process pool is used.
+    :return: An Address per input in input order, or None where the address could not be parsed.
+    """
+    full_addresses = list(full_addresses)
+    workers = workers or os.cpu_count() or 1
+
+    components = {}
+    misses = []
+    for full_address in dict.fromkeys(full_addresses):
+        cached = _get_parsed(full_address)
+        if cached is None and _parse_cache is not None:
+            cached = _parse_cache.get(full_address)
+        if cached is not None:
+            components[full_address] = cached
+        else:
+            misses.append(full_address)
+
+    if len(misses) < serial_threshold or workers == 1:
+        for full_address in misses:
+            try:
+                components[full_address] = parse_address_components(full_address)
+            except Exception:
+                components[full_address] = None
+    else:
+        chunksize = max(1, len(misses) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for full_address, parsed in zip(misses, executor.map(_parse_or_none, misses, chunksize=chunksize)):
+                components[full_address] = parsed
+                if parsed is not None:
+                    _put_parsed(full_address, parsed)
+                    if _parse_cache is not None:
+                        _parse_cache.put(full_address, parsed)
+
+    return [
+        Address(full_address, components[full_address]) if components[full_address] is not None else None
+        for full_address in full_addresses
+    ]
+
+
+class _PrefetchError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(iterable: Iterable, maxsize: int = 100) -> Iterator:
+    """
+    Run an iterable in a background thread and hand its items over through a bounded queue.
+
+    Chaining generators through prefetch() turns them into overlapping pipeline stages: the producer keeps working
+    while the consumer handles earlier items, and blocks once maxsize items are waiting. Exceptions raised by the
+    producer are re-raised in the consumer.
+
+    :param iterable: The iterable to run in the background.
+    :param maxsize: How many items may be waiting to be consumed.
+    :return: A generator yielding the items of iterable in order.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_PrefetchError(e))
+            return
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        # Lets the producer give up if the consumer stopped early
+        stopped.set()
+
+
+class RateLimiter:
+    """Spaces out calls made from any number of threads to at most rate calls per second"""
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
@@ -0,0 +1,333 @@
+import datetime
+import math
+import sys
+
+from array import array
+from gspread.utils import numericise, rowcol_to_a1
+from helpers import format_sheet_datetime, parse_sheet_datetimes
+from itertools import compress
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def mask_and(*masks: bytes) -> bytes:
+    """Element-wise AND of 0/1 byte masks of equal length"""
+    length = len(masks[0])
+    result = int.from_bytes(masks[0], "little")
+    for mask in masks[1:]:
+        result &= int.from_bytes(mask, "little")
+
+    return result.to_bytes(length, "little")
+
+
+def mask_or(*masks: bytes) -> bytes:
+    """Element-wise OR of 0/1 byte masks of equal length"""
+    length = len(masks[0])
+    result = int.from_bytes(masks[0], "little")
+    for mask in masks[1:]:
+        result |= int.from_bytes(mask, "little")
+
+    return result.to_bytes(length, "little")
+
+
+def mask_not(mask: bytes) -> bytes:
+    """Element-wise NOT of a 0/1 byte mask"""
+    ones = int.from_bytes(b"\x01" * len(mask), "little")
+
+    return (int.from_bytes(mask, "little") ^ ones).to_bytes(len(mask), "little")
+
+
+class _TextColumn:
+    """Values as numericised by gspread, with strings interned so repeated values share one object"""
+
+    def __init__(self, values: List[Any]):
+        self.values = values
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> "_TextColumn":
+        return cls([sys.intern(value) if isinstance(value, str) else value for value in map(numericise, strings)])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.values)
+
+    def __getitem__(self, index: int) -> Any:
+        return self.values[index]
+
+    def __setitem__(self, index: int, value: Any):
+        self.values[index] = sys.intern(value) if isinstance(value, str) else value
+
+    def truthy(self) -> bytes:
+        return bytes(map(bool, self.values))
+
+    def blank(self) -> bytes:
+        return bytes([value == "" for value in self.values])
+
+
+class _IntColumn:
+    """Whole numbers (phone numbers, zip codes, flags) in a 64-bit array, with blanks tracked in a byte mask"""
+
+    def __init__(self, values: array, present: bytearray):
+        self.values = values
+        self.present = present
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> Union[None, "_IntColumn"]:
+        """Builds the column, or returns None when some value is not a whole number that fits or all are blank"""
+        values = array("q")
+        present = bytearray(len(strings))
+        try:
+            for index, value in enumerate(map(numericise, strings)):
+                if value == "":
+                    values.append(0)
+                elif type(value) is int:
+                    values.append(value)
+                    present[index] = 1
+                else:
+                    return None
+        except OverflowError:
+            return None
+
+        return cls(values, present) if any(present) else None
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Any]:
+        return (value if present else "" for value, present in zip(self.values, self.present))
+
+    def __getitem__(self, index: int) -> Any:
+        return self.values[index] if self.present[index] else ""
+
+    def __setitem__(self, index: int, value: Any):
+        # Raises TypeError or OverflowError for values the array cannot hold, see LeadFrame.set()
+        if value == "":
+            self.values[index] = 0
+            self.present[index] = 0
+        else:
+            self.values[index] = value
+            self.present[index] = 1
+
+    def truthy(self) -> bytes:
+        return bytes([bool(present and value) for value, present in zip(self.values, self.present)])
+
+    def blank(self) -> bytes:
+        return mask_not(bytes(self.present))
+
+
+class _DateTimeColumn:
+    """
+    Timestamps in the sheet's "%m/%d/%Y %H:%M:%S" format, stored as seconds since 1970-01-01 local time in a float
+    array (NaN for blanks). Values that do not parse, or would not format back to the exact same string, are kept
+    verbatim on the side.
+    """
+
+    def __init__(self, values: array, verbatim: Dict[int, Any]):
+        self.values = values
+        self.verbatim = verbatim
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> "_DateTimeColumn":
+        values = array("d", [math.nan]) * len(strings)
+        verbatim = {}
+        for index, (value, parsed) in enumerate(zip(strings, parse_sheet_datetimes(strings))):
+            if value == "":
+                continue
+            if parsed is None:
+                verbatim[index] = numericise(value)
+                continue
+
+            if len(value) != 19:
+                verbatim[index] = value
+            values[index] = (parsed - EPOCH).total_seconds()
+
+        return cls(values, verbatim)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(len(self.values)):
+            yield self[index]
+
+    def __getitem__(self, index: int) -> Any:
+        if index in self.verbatim:
+            return self.verbatim[index]
+
+        value = self.values[index]
+        if math.isnan(value):
+            return ""
+
+        return format_sheet_datetime(EPOCH + datetime.timedelta(seconds=value))
+
+    def __setitem__(self, index: int, value: Any):
+        self.verbatim.pop(index, None)
+        if isinstance(value, datetime.datetime):
+            self.values[index] = (value - EPOCH).total_seconds()
+            return
+
+        replacement = self.from_strings([value])
+        self.values[index] = replacement.values[0]
+        if 0 in replacement.verbatim:
+            self.verbatim[index] = replacement.verbatim[0]
+
+    def parsed(self, index: int) -> Union[None, datetime.datetime]:
+        """The value as a datetime, or None if it is blank or could not be parsed"""
+        value = self.values[index]
+        if math.isnan(value):
+            return None
+
+        return EPOCH + datetime.timedelta(seconds=value)
+
+    def truthy(self) -> bytes:
+        return mask_not(self.blank())
+
+    def blank(self) -> bytes:
+        mask = bytearray([math.isnan(value) for value in self.values])
+        for index, value in self.verbatim.items():
+            mask[index] = value == ""
+
+        return bytes(mask)
+
+
+class LeadFrame:
+    """
+    Columnar in-memory copy of a worksheet such as Leads Master.
+
+    Each header gets one column: whole-number columns are backed by a 64-bit integer array, columns whose header
+    contains "DateTime" by a float array of pre-parsed timestamps, and everything else by a list of interned strings
+    and numbers. Values read back out look the same as in get_all_records.
+
+    Predicates are evaluated a column at a time into 0/1 byte masks that can be combined with mask_and(), mask_or()
+    and mask_not(), and where() turns a mask into row indexes. Row index 0 is sheet row 2.
+    """
+
+    def __init__(self, header: List[str], columns: List[Union[_TextColumn, _IntColumn, _DateTimeColumn]], length: int):
+        self.header = header
+        self.columns = columns
+        self.length = length
+        # The first column with a given header wins, like SheetSchema
+        self.positions: Dict[str, int] = {}
+        for position, name in enumerate(header):
+            if name and name not in self.positions:
+                self.positions[name] = position
+
+    @classmethod
+    def from_values(cls, values: List[List[str]]) -> "LeadFrame":
+        """
+        Build a frame from raw worksheet values.
+
+        :param values: All values of the worksheet including the header row, as returned by get_all_values.
+        :return: The frame.
+        """
+        if not values:
+            return cls([], [], 0)
+
+        header = list(values[0])
+        while header and header[-1] == "":
+            header.pop()
+        rows = values[1:]
+
+        columns = []
+        for position, name in enumerate(header):
+            strings = [row[position] if position < len(row) else "" for row in rows]
+            if "DateTime" in name:
+                column = _DateTimeColumn.from_strings(strings)
+            else:
+                column = _IntColumn.from_strings(strings) or _TextColumn.from_strings(strings)
+            columns.append(column)
+
+        return cls(header, columns, len(rows))
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.positions
+
+    def column(self, name: str) -> Union[_TextColumn, _IntColumn, _DateTimeColumn]:
+        """Returns the column with the given header, raising KeyError if there is none"""
+        return self.columns[self.positions[name]]
+
+    def get(self, index: int, name: str) -> Any:
+        return self.column(name)[index]
+
+    def set(self, index: int, name: str, value: Any):
+        position = self.positions[name]
+        try:
+            self.columns[position][index] = value
+        except (TypeError, OverflowError):
+            # An integer column given text falls back to a plain column
+            self.columns[position] = _TextColumn([sys.intern(v) if isinstance(v, str) else v for v in self.columns[position]])
+            self.columns[position][index] = value
+
+    def parsed(self, index: int, name: str) -> Union[None, datetime.datetime]:
+        """The value of a DateTime column as a datetime, or None if it is blank or could not be parsed"""
+        return self.column(name).parsed(index)
+
+    def record(self, index: int) -> Dict[str, Any]:
+        """Materializes one row as a dictionary, in the same shape as an entry of get_all_records"""
+        return {name: self.columns[position][index] for name, position in self.positions.items()}
+
+    def truthy(self, name: str) -> bytes:
+        return self.column(name).truthy()
+
+    def blank(self, name: str) -> bytes:
+        return self.column(name).blank()
+
+    @staticmethod
+    def where(mask: bytes) -> List[int]:
+        """The row indexes selected by a mask"""
+        return list(compress(range(len(mask)), mask))
+
+    def skip_trace_mask(self) -> bytes:
+        """Rows due for skip tracing: not skip traced yet, contact address complete and a phone slot free"""
+        return mask_and(
+            self.blank("SkipTraceSuccess"),
+            self.truthy("ContactCity"),
+            self.truthy("ContactStreet"),
+            self.truthy("ContactState"),
+            self.truthy("ContactZip"),
+            mask_not(mask_and(self.truthy("ContactPhone1"), self.truthy("ContactPhone2"), self.truthy("ContactPhone3")))
+        )
+
+    def queue_mask(self) -> bytes:
+        """Rows that may have messages to queue: a target street and at least one message not queued yet"""
+        return mask_and(
+            mask_or(self.blank("SMS1QueuedDateTime"), self.blank("SMS2QueuedDateTime"), self.blank("SMS3QueuedDateTime")),
+            self.truthy("TargetStreet")
+        )
+
+    def to_values(self, start: int = 0, stop: int = None) -> List[List[Any]]:
+        """
+        Serialize rows back to cell values.
+
+        :param start: The first row index.
+        :param stop: The row index to stop before, defaults to the end of the frame.
+        :return: One list of values per row covering every header column, ready for a range update.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        columns = []
+        for column in self.columns:
+            if isinstance(column, _TextColumn):
+                columns.append(column.values[start:stop])
+            else:
+                columns.append([column[index] for index in range(start, stop)])
+
+        return [list(row) for row in zip(*columns)]
+
+    def to_range(self, start: int = 0, stop: int = None) -> Tuple[str, List[List[Any]]]:
+        """
+        Serialize rows to a sheet range.
+
+        :param start: The first row index.
+        :param stop: The row index to stop before, defaults to the end of the frame.
+        :return: The A1 range the rows belong in and their values, as taken by GoogleSheetClient.update().
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        range_name = f"{rowcol_to_a1(start + 2, 1)}:{rowcol_to_a1(max(stop + 1, start + 2), max(len(self.header), 1))}"
+
+        return range_name, self.to_values(start, stop)
@@ -4,6 +4,9 @@ import logging
 import os
 
 from clients import WYANGovClient, GoogleSheetClient
+from dedup import AddressIndex
+from helpers import format_sheet_datetime, use_parse_cache
+from storage import AddressParseCache
 from datetime import datetime
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -39,40 +42,53 @@ async def get_wyan_code_violation(sheet_client: GoogleSheetClient, config: dict)
     type_col_num = sheet_client.get_column_index("Type")
     source_col_num = sheet_client.get_column_index("Source")
 
-    existing_leads = sheet_client.read_records()
-    last_row = len(existing_leads) + 2
+    address_index = AddressIndex(os.path.join(script_dir, config.get("address_index_file", "address_index.sqlite3")), logger)
+    try:
+        address_index.refresh(sheet_client)
+        last_row = address_index.next_row
 
-    existing_addresses = [" ".join([existing_lead["TargetStreet"].lower(), existing_lead["TargetCity"].lower(), existing_lead["TargetState"].lower(), str(existing_lead["TargetZip"])]) for existing_lead in existing_leads]
-    now = datetime.now()
-    values = []
-    async with WYANGovClient(config["chromium_path"], logger, config["types_mapping"], width=1920, height=1920) as client:
-        leads = await client.get_code_violations()
-        for index, lead in enumerate(leads):
-            lead_address = lead["address"]
-            address = " ".join([lead_address.street_name.lower(), lead_address.city.lower(), lead_address.state.lower(), lead_address.zip])
-            if address not in existing_addresses:
-                lead_values = []
-                lead_values = extend_and_add(lead_values, target_street_col_num - 1, lead_address.street_name)
-                lead_values = extend_and_add(lead_values, target_city_col_num - 1, lead_address.city)
-                lead_values = extend_and_add(lead_values, target_state_col_num - 1, lead_address.state)
-                lead_values = extend_and_add(lead_values, target_zip_col_num - 1, lead_address.zip)
-                lead_values = extend_and_add(lead_values, contact_street_col_num - 1, lead_address.street_name)
-                lead_values = extend_and_add(lead_values, contact_city_col_num - 1, lead_address.city)
-                lead_values = extend_and_add(lead_values, contact_state_col_num - 1, lead_address.state)
-                lead_values = extend_and_add(lead_values, contact_zip_col_num - 1, lead_address.zip)
-                lead_values = extend_and_add(lead_values, datetime_added_col_num - 1, now.strftime("%m/%d/%Y %H:%M:%S"))
-                lead_values = extend_and_add(lead_values, type_col_num - 1, lead["lead_type"])
-                lead_values = extend_and_add(lead_values, source_col_num - 1, "Bob")
-                lead_values.pop(0)
-                existing_addresses.append(address)
-                values.append(lead_values)
-        values.append([""])
-        sheet_client.sheet.update(values, f"B{last_row}")
+        datetime_added_str = format_sheet_datetime(datetime.now())
+        values = []
+        async with WYANGovClient(config["chromium_path"], logger, config["types_mapping"], width=1920, height=1920) as client:
+            leads = await client.get_code_violations()
+            for index, lead in enumerate(leads):
+                lead_address = lead["address"]
+                address = lead_address.key
+                if address not in address_index:
+                    lead_values = []
+                    lead_values = extend_and_add(lead_values, target_street_col_num - 1, lead_address.street_name)
+                    lead_values = extend_and_add(lead_values, target_city_col_num - 1, lead_address.city)
+                    lead_values = extend_and_add(lead_values, target_state_col_num - 1, lead_address.state)
+                    lead_values = extend_and_add(lead_values, target_zip_col_num - 1, lead_address.zip)
+                    lead_values = extend_and_add(lead_values, contact_street_col_num - 1, lead_address.street_name)
+                    lead_values = extend_and_add(lead_values, contact_city_col_num - 1, lead_address.city)
+                    lead_values = extend_and_add(lead_values, contact_state_col_num - 1, lead_address.state)
+                    lead_values = extend_and_add(lead_values, contact_zip_col_num - 1, lead_address.zip)
+                    lead_values = extend_and_add(lead_values, datetime_added_col_num - 1, datetime_added_str)
+                    lead_values = extend_and_add(lead_values, type_col_num - 1, lead["lead_type"])
+                    lead_values = extend_and_add(lead_values, source_col_num - 1, "Bob")
+                    lead_values.pop(0)
+                    address_index.add(address)
+                    values.append(lead_values)
+            appended_rows = len(values)
+            values.append([""])
+            sheet_client.update(values, f"B{last_row}")
+            address_index.commit(appended_rows)
+    finally:
+        address_index.close()
 
 
 if __name__ == "__main__":
     with open(os.path.join(script_dir, 'config.json'), 'rb') as config_file:
         master_config = json.load(config_file)
 
-    google_sheet_client = GoogleSheetClient(os.path.join(script_dir, "credentials-file.json"), "SAM", logger)
+    use_parse_cache(AddressParseCache(os.path.join(script_dir, master_config.get("address_cache_file", "address_cache.sqlite3"))))
+
+    mirror_file = master_config.get("sheet_mirror_file")
+    google_sheet_client = GoogleSheetClient(
+        os.path.join(script_dir, "credentials-file.json"),
+        "SAM",
+        logger,
+        mirror_path=os.path.join(script_dir, mirror_file) if mirror_file else None
+    )
     asyncio.run(get_wyan_code_violation(google_sheet_client, master_config))
@@ -3,9 +3,13 @@ import json
 import logging
 import os
 import random
-import requests
 
-from clients import GoogleSheetClient, BatchDataClient, DealMachineClient, BatchAPIError
+from clients import GoogleSheetClient, BatchDataClient, DealMachineClient, HttpTransport, SmsQueueClient, load_config
+from dedup import AddressIndex
+from due_index import DueIndex
+from helpers import format_sheet_datetime, prefetch, use_parse_cache
+from storage import AddressParseCache
+from typing import Union
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger("leads_manager_logger")
@@ -15,16 +19,6 @@ logger.addHandler(file_handler)
 logger.setLevel(logging.INFO)
 
 
-def validate_lead(lead: dict):
-    try:
-        if lead["SkipTraceSuccess"] == "" and lead["ContactCity"] and lead["ContactStreet"] and lead["ContactState"] and lead["ContactZip"] and not (lead["ContactPhone1"] and lead["ContactPhone2"] and lead["ContactPhone3"]):
-            return True
-    except KeyError as e:
-        logger.error(e, exc_info=True)
-
-    return False
-
-
 def extend_and_add(lst, index, value, filler=""):
     # Extend the list with the filler value up to the required index
     if index >= len(lst):
@@ -36,82 +30,127 @@ def extend_and_add(lst, index, value, filler=""):
     return lst
 
 
-def skip_trace(sheet_client: GoogleSheetClient):
+def lead_priority(priority_mapping: dict, lead_type: str) -> int:
+    mapping = [mapping for mapping in priority_mapping.values() if mapping.get("display_name") == lead_type]
+    return mapping[0].get("priority", 0) if mapping else 0
+
+
+def load_skip_trace_spend(spend_path: str) -> float:
+    """Returns how much has been spent on skip tracing today"""
+    if not os.path.exists(spend_path):
+        return 0
+
+    with open(spend_path, 'rb') as spend_file:
+        spend = json.load(spend_file)
+
+    return spend["spent"] if spend.get("date") == datetime.date.today().isoformat() else 0
+
+
+def record_skip_trace_spend(spend_path: str, amount: float):
+    spent = load_skip_trace_spend(spend_path) + amount
+    with open(spend_path, 'w') as spend_file:
+        json.dump({"date": datetime.date.today().isoformat(), "spent": spent}, spend_file)
+
+
+def get_skip_trace_limit(skip_trace_config: dict, spend_path: str) -> Union[None, int]:
+    """
+    Work out how many uncached leads may be sent to BatchData this run.
+
+    :param skip_trace_config: The "skip_trace" section of the config.
+    :param spend_path: The file today's spend is tracked in.
+    :return: The maximum number of leads to trace, or None for no limit.
+    """
+    limit = skip_trace_config.get("max_per_run", 5)
+
+    cost_per_lead = skip_trace_config.get("cost_per_lead", 0)
+    if cost_per_lead:
+        budgets = []
+        if skip_trace_config.get("run_budget") is not None:
+            budgets.append(skip_trace_config["run_budget"])
+        if skip_trace_config.get("daily_budget") is not None:
+            budgets.append(skip_trace_config["daily_budget"] - load_skip_trace_spend(spend_path))
+
+        if budgets:
+            # Rounded first so float error in the division doesn't cost a lead
+            affordable = max(int(round(min(budgets) / cost_per_lead, 6)), 0)
+            limit = affordable if limit is None else min(limit, affordable)
+
+    return limit
+
+
+def skip_trace(sheet_client: GoogleSheetClient, config: dict):
+    skip_trace_config = config.get("skip_trace", {})
+    spend_path = os.path.join(script_dir, skip_trace_config.get("spend_file", "skip_trace_spend.json"))
+    limit = get_skip_trace_limit(skip_trace_config, spend_path)
+    if limit == 0:
+        logger.info("Skip trace budget used up, skipping...")
+        return
+
     sheet_client.open_sheet("Leads Master")
     contact_phone1_col_num = sheet_client.get_column_index("ContactPhone1")
     contact_phone2_col_num = sheet_client.get_column_index("ContactPhone2")
     contact_phone3_col_num = sheet_client.get_column_index("ContactPhone3")
     skip_trace_result_col_num = sheet_client.get_column_index("SkipTraceSuccess")
 
-    leads = sheet_client.read_records()
-    with BatchDataClient(logger, os.path.join(script_dir, "config.json")) as client:
-        skip_trace_count = 0
-        for index, lead in enumerate(leads):
-            row_num = index + 2
-            leads_lst = [value for value in lead.values()]
-            if validate_lead(lead) and skip_trace_count < 5:
-                try:
-                    traced_phone_numbers = client.skip_trace(
-                        str(lead["ContactCity"]),
-                        str(lead["ContactStreet"]),
-                        str(lead["ContactState"]),
-                        str(lead["ContactZip"]),
-                        first_name=str(lead["ContactFirstName"]),
-                        last_name=str(lead["ContactLastName"])
-                    )
-
-                    if traced_phone_numbers:
-                        leads_lst = extend_and_add(leads_lst, skip_trace_result_col_num - 1, "TRUE")
-                        try:
-                            leads_lst = extend_and_add(leads_lst, contact_phone1_col_num - 1, traced_phone_numbers[0])
-                            leads_lst = extend_and_add(leads_lst, contact_phone2_col_num - 1, traced_phone_numbers[1])
-                            leads_lst = extend_and_add(leads_lst, contact_phone3_col_num - 1, traced_phone_numbers[2])
-                        except IndexError:
-                            pass
-                    else:
-                        logger.warning(f"No phone numbers found for address: {lead['ContactStreet']} {lead['ContactCity']} {lead['ContactState']} {lead['ContactZip']}")
-                        leads_lst = extend_and_add(leads_lst, skip_trace_result_col_num - 1, "FALSE")
-                except BatchAPIError as e:
-                    logger.warning(e)
-                    logger.info("Skip tracing skipped...")
-                    break
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-                    leads_lst = extend_and_add(leads_lst, skip_trace_result_col_num - 1, "FALSE")
-                skip_trace_count += 1
-                sheet_client.sheet.update([leads_lst], f"A{row_num}")
-            elif skip_trace_count >= 3:
-                break
-
-
-def validate_phones_lead(lead: dict):
+    # Highest priority lead types are traced first, sheet order is kept within a priority
+    leads = sheet_client.read_frame()
     try:
-        if (lead["SMS1QueuedDateTime"] == "" or lead["SMS2QueuedDateTime"] == "" or lead["SMS3QueuedDateTime"] == "") and lead["TargetStreet"]:
-            return True
+        to_trace = [(index + 2, leads.record(index)) for index in leads.where(leads.skip_trace_mask())]
     except KeyError as e:
         logger.error(e, exc_info=True)
-
-    return False
-
-
-def not_queued_and_phone_present(lead, phone_key, queued_key):
-    return lead[queued_key] == "" and lead[phone_key] != ""
-
-
-def is_delay_met_for_phone(lead: dict, message_index: int, config: dict):
-    if message_index > 1:
-        previous_queued_key = f"SMS{message_index - 1}SentDateTime"
-        if lead[previous_queued_key] != "":
-            previous_queued_time = datetime.datetime.strptime(lead[previous_queued_key], "%m/%d/%Y %H:%M:%S")
-            return previous_queued_time + datetime.timedelta(days=config["delay_between_messages"]) < datetime.datetime.now()
-        else:
-            return False
-    return True
+        return
+    to_trace.sort(key=lambda item: -lead_priority(config["types_mapping"], item[1]["Type"]))
+
+    cache_path = os.path.join(script_dir, "skip_trace_cache.sqlite3")
+    with BatchDataClient(logger, os.path.join(script_dir, "config.json"), cache_path=cache_path) as client:
+        results = client.skip_trace_many(
+            [
+                {
+                    "city": str(lead["ContactCity"]),
+                    "street": str(lead["ContactStreet"]),
+                    "state": str(lead["ContactState"]),
+                    "zipcode": str(lead["ContactZip"]),
+                    "first_name": str(lead["ContactFirstName"]),
+                    "last_name": str(lead["ContactLastName"])
+                }
+                for _, lead in to_trace
+            ],
+            batch_size=skip_trace_config.get("batch_size", 100),
+            workers=skip_trace_config.get("workers", 4),
+            requests_per_second=skip_trace_config.get("requests_per_second", 2),
+            limit=limit
+        )
+
+        spent = client.traced_count * skip_trace_config.get("cost_per_lead", 0)
+        record_skip_trace_spend(spend_path, spent)
+        logger.info(f"Skip traced {client.traced_count} leads for {spent}")
+        if client.last_error:
+            logger.info("Skip tracing stopped early...")
+
+    # Every result is written back in one batch once tracing is done
+    phone_col_nums = [contact_phone1_col_num, contact_phone2_col_num, contact_phone3_col_num]
+    with sheet_client.writer(max_cells=len(to_trace) * 4 + 1, flush_interval=0) as writer:
+        for (row_num, lead), result in zip(to_trace, results):
+            if result is None:
+                continue
+
+            traced_phone_numbers = result["phone_numbers"]
+            if result["retry"]:
+                logger.warning(f"Row {row_num} was not skip traced and is left for the next run: {result['error']}")
+            elif result["error"]:
+                logger.error(f"Skip trace failed for row {row_num}: {result['error']}")
+                writer.update_cell(row_num, skip_trace_result_col_num, "FALSE")
+            elif traced_phone_numbers:
+                writer.update_cell(row_num, skip_trace_result_col_num, "TRUE")
+                for phone_col_num, phone_number in zip(phone_col_nums, traced_phone_numbers):
+                    writer.update_cell(row_num, phone_col_num, phone_number)
+            else:
+                logger.warning(f"No phone numbers found for address: {lead['ContactStreet']} {lead['ContactCity']} {lead['ContactState']} {lead['ContactZip']}")
+                writer.update_cell(row_num, skip_trace_result_col_num, "FALSE")
 
 
 def queue_messages(sheet_client: GoogleSheetClient):
-    with open(os.path.join(script_dir, 'config.json'), 'rb') as config_file:
-        config = json.load(config_file)
+    config = load_config(os.path.join(script_dir, 'config.json'))
 
     priority_mapping = config["types_mapping"]
     sheet_client.open_sheet("Message Templates")
@@ -119,59 +158,66 @@ def queue_messages(sheet_client: GoogleSheetClient):
     messages = [message["Message"] for message in messages]
 
     sheet_client.open_sheet("Leads Master")
-    leads = sheet_client.read_records()
+    leads = sheet_client.read_frame()
 
     now = datetime.datetime.now()
-    time_queued_str = now.strftime("%m/%d/%Y %H:%M:%S")
+    time_queued_str = format_sheet_datetime(now)
     msg_queued_col_numbers = {
         1: sheet_client.get_column_index("SMS1QueuedDateTime"),
         2: sheet_client.get_column_index("SMS2QueuedDateTime"),
         3: sheet_client.get_column_index("SMS3QueuedDateTime"),
     }
-    leads_values = []
     logger.info("Running queue messages")
 
-    for index, lead in enumerate(leads):
-        row_num = index + 2
-        leads_lst = [value for value in lead.values()]
-        if validate_phones_lead(lead):
-            for message_index in range(1, 4):
-                phone_key = f"ContactPhone{message_index}"
-                queued_key = f"SMS{message_index}QueuedDateTime"
-                if not_queued_and_phone_present(lead, phone_key, queued_key) and is_delay_met_for_phone(lead, message_index, config):
-                    try:
-                        mapping = [mapping for mapping in priority_mapping.values() if mapping["display_name"] == lead["Type"]]
-                        if mapping:
-                            priority = mapping[0]["priority"]
-                        else:
-                            priority = 0
-                            logger.warning(f"No mapping found with display name {lead['Type']}")
-                    except KeyError:
-                        priority = 0
-                        logger.warning(f"Priority not found for \"{lead['Type']}\" lead type")
-                    logger.info("Queuing sms")
-                    message = random.choice(messages).replace("{TargetStreet}", lead["TargetStreet"])
-                    payload = {
-                        "recipient": f"+1{lead[phone_key]}",
-                        "message": message,
-                        "priority": priority
-                    }
-                    headers = {
-                        'accept': 'application/json',
-                        'Content-Type': 'application/json'
-                    }
-                    response = requests.post('http://localhost:4723/api/v1/sms/', headers=headers, json=payload)
-
-                    if response.status_code == 201:
-                        logger.info(response.content)
-                        extend_and_add(leads_lst, msg_queued_col_numbers[message_index] - 1, time_queued_str)
-                        lead[queued_key] = time_queued_str
-                    else:
-                        logger.error(f"Failed to queue message for lead {row_num}. Status code: {response.status_code}, Response: {response.text}")
-
-        leads_values.append(leads_lst)
-
-    sheet_client.sheet.update(leads_values, "A2")
+    # Only lead phone slots that are due come off the index, leads whose stamps did not change are not re-evaluated
+    due_index = DueIndex(os.path.join(script_dir, config.get("due_index_file", "due_index.sqlite3")), logger)
+    try:
+        if not due_index.refresh(leads, config["delay_between_messages"]):
+            return
+
+        # Messages are collected first and submitted together, each one remembers the cell to stamp once it is accepted
+        queued = []
+        payloads = []
+        for row_num, message_index in due_index.pop_due(now):
+            lead = leads.record(row_num - 2)
+            phone_key = f"ContactPhone{message_index}"
+            try:
+                mapping = [mapping for mapping in priority_mapping.values() if mapping["display_name"] == lead["Type"]]
+                if mapping:
+                    priority = mapping[0]["priority"]
+                else:
+                    priority = 0
+                    logger.warning(f"No mapping found with display name {lead['Type']}")
+            except KeyError:
+                priority = 0
+                logger.warning(f"Priority not found for \"{lead['Type']}\" lead type")
+            message = random.choice(messages).replace("{TargetStreet}", lead["TargetStreet"])
+            payloads.append({
+                "recipient": f"+1{lead[phone_key]}",
+                "message": message,
+                "priority": priority
+            })
+            queued.append((row_num, message_index))
+
+        logger.info(f"Queuing {len(payloads)} sms")
+        sms_queue = SmsQueueClient(
+            logger,
+            config.get("sms_queue_url", "http://localhost:4723/api/v1"),
+            batch_size=config.get("sms_queue_batch_size", 100),
+            concurrency=config.get("sms_queue_concurrency", 8)
+        )
+        accepted = sms_queue.enqueue_many(payloads)
+
+        # Only the queued stamps that actually change are written back
+        accepted_slots = [slot for slot, is_accepted in zip(queued, accepted) if is_accepted]
+        with sheet_client.writer() as writer:
+            for row_num, message_index in accepted_slots:
+                writer.update_cell(row_num, msg_queued_col_numbers[message_index], time_queued_str)
+
+        due_index.remove(accepted_slots)
+        logger.info(f"Queued {sum(accepted)} of {len(payloads)} sms")
+    finally:
+        due_index.close()
 
 
 def import_from_deal_machine(sheet_client: GoogleSheetClient, config: dict):
@@ -188,53 +234,79 @@ def import_from_deal_machine(sheet_client: GoogleSheetClient, config: dict):
     type_col_num = sheet_client.get_column_index("Type")
     source_col_num = sheet_client.get_column_index("Source")
 
-    existing_leads = sheet_client.read_records()
-    last_row = len(existing_leads) + 2
-
-    existing_addresses = [" ".join([existing_lead["TargetStreet"].lower(), existing_lead["TargetCity"].lower(),
-                                    existing_lead["TargetState"].lower(), str(existing_lead["TargetZip"])]) for
-                          existing_lead in existing_leads]
-    types_mapping = config["types_mapping"]
-    now = datetime.datetime.now()
-    values = []
-    with DealMachineClient(logger, os.path.join(script_dir, "config.json")) as client:
-        leads = client.get_leads()
-        for index, lead in enumerate(leads):
-            contact_address = lead["contact_address"]
-            target_address = lead["target_address"]
-            address = " ".join([target_address.street_name.lower(), target_address.city.lower(), target_address.state.lower(), target_address.zip])
-            if address not in existing_addresses:
-                try:
-                    lead_type = types_mapping[lead["type"]]["display_name"]
-                except KeyError:
-                    lead_type = "Deal Machine Import"
-
-                lead_values = []
-                lead_values = extend_and_add(lead_values, target_street_col_num - 1, target_address.street_name)
-                lead_values = extend_and_add(lead_values, target_city_col_num - 1, target_address.city)
-                lead_values = extend_and_add(lead_values, target_state_col_num - 1, target_address.state)
-                lead_values = extend_and_add(lead_values, target_zip_col_num - 1, target_address.zip)
-                lead_values = extend_and_add(lead_values, contact_street_col_num - 1, contact_address.street_name)
-                lead_values = extend_and_add(lead_values, contact_city_col_num - 1, contact_address.city)
-                lead_values = extend_and_add(lead_values, contact_state_col_num - 1, contact_address.state)
-                lead_values = extend_and_add(lead_values, contact_zip_col_num - 1, contact_address.zip)
-                lead_values = extend_and_add(lead_values, datetime_added_col_num - 1, now.strftime("%m/%d/%Y %H:%M:%S"))
-                lead_values = extend_and_add(lead_values, type_col_num - 1, lead_type)
-                lead_values = extend_and_add(lead_values, source_col_num - 1, lead["creator"])
-                existing_addresses.append(address)
-                lead_values.pop(0)
-                values.append(lead_values)
-        values.append([""])
-        sheet_client.sheet.update(values, f"B{last_row}")
+    address_index = AddressIndex(os.path.join(script_dir, config.get("address_index_file", "address_index.sqlite3")), logger)
+    try:
+        address_index.refresh(sheet_client)
+        last_row = address_index.next_row
+
+        types_mapping = config["types_mapping"]
+        now = datetime.datetime.now()
+        datetime_added_str = format_sheet_datetime(now)
+        appended_rows = 0
+        # A row holds at most one cell per column, so the row limit is always reached first
+        flush_rows = config.get("import_flush_rows", 500)
+        sync_state_path = os.path.join(script_dir, config.get("deal_machine_sync_file", "deal_machine_sync.json"))
+        with DealMachineClient(
+            logger,
+            os.path.join(script_dir, "config.json"),
+            sync_state_path=sync_state_path,
+            concurrency=config.get("deal_machine_concurrency", 4),
+            full_resync_days=config.get("deal_machine_full_resync_days", 7)
+        ) as client, sheet_client.writer(max_cells=flush_rows * len(sheet_client.columns), max_rows=flush_rows) as writer:
+            # Fetching and parsing run ahead in the background while leads are deduped and appended here.
+            # Incremental syncs only read pages past the last high-water mark, so a lead edited or moved into the
+            # D4D/RD4D lists on an earlier page is only picked up by the next full resync, up to
+            # deal_machine_full_resync_days later. Set deal_machine_incremental to false to always read every page.
+            leads = prefetch(client.iter_leads(incremental=config.get("deal_machine_incremental", True)), maxsize=1000)
+            for lead in leads:
+                contact_address = lead["contact_address"]
+                target_address = lead["target_address"]
+                address = target_address.key
+                if address not in address_index:
+                    try:
+                        lead_type = types_mapping[lead["type"]]["display_name"]
+                    except KeyError:
+                        lead_type = "Deal Machine Import"
+
+                    lead_values = []
+                    lead_values = extend_and_add(lead_values, target_street_col_num - 1, target_address.street_name)
+                    lead_values = extend_and_add(lead_values, target_city_col_num - 1, target_address.city)
+                    lead_values = extend_and_add(lead_values, target_state_col_num - 1, target_address.state)
+                    lead_values = extend_and_add(lead_values, target_zip_col_num - 1, target_address.zip)
+                    lead_values = extend_and_add(lead_values, contact_street_col_num - 1, contact_address.street_name)
+                    lead_values = extend_and_add(lead_values, contact_city_col_num - 1, contact_address.city)
+                    lead_values = extend_and_add(lead_values, contact_state_col_num - 1, contact_address.state)
+                    lead_values = extend_and_add(lead_values, contact_zip_col_num - 1, contact_address.zip)
+                    lead_values = extend_and_add(lead_values, datetime_added_col_num - 1, datetime_added_str)
+                    lead_values = extend_and_add(lead_values, type_col_num - 1, lead_type)
+                    lead_values = extend_and_add(lead_values, source_col_num - 1, lead["creator"])
+                    address_index.add(address)
+                    lead_values.pop(0)
+                    writer.update_row(last_row + appended_rows, lead_values, start_col=2)
+                    appended_rows += 1
+
+        address_index.commit(appended_rows)
+        client.save_sync_state()
+    finally:
+        address_index.close()
 
 
 if __name__ == "__main__":
     logger.info("TEST")
-    with open(os.path.join(script_dir, 'config.json'), 'rb') as config_file:
-        master_config = json.load(config_file)
+    master_config = load_config(os.path.join(script_dir, 'config.json'))
 
-    google_sheet_client = GoogleSheetClient(os.path.join(script_dir, "credentials-file.json"), "SAM", logger)
+    use_parse_cache(AddressParseCache(os.path.join(script_dir, master_config.get("address_cache_file", "address_cache.sqlite3"))))
+
+    mirror_file = master_config.get("sheet_mirror_file")
+    google_sheet_client = GoogleSheetClient(
+        os.path.join(script_dir, "credentials-file.json"),
+        "SAM",
+        logger,
+        mirror_path=os.path.join(script_dir, mirror_file) if mirror_file else None
+    )
 
     import_from_deal_machine(google_sheet_client, master_config)
-    # skip_trace(google_sheet_client)
+    # skip_trace(google_sheet_client, master_config)
     queue_messages(google_sheet_client)
+
+    HttpTransport.shared(logger).log_metrics()
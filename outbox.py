@@ -0,0 +1,222 @@
+import json
+import logging
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from helpers import parse_sheet_datetime
+from typing import Union
+
+
+class Outbox:
+    """
+    Durable priority queue of outgoing SMS, fed from the Message Queue sheet.
+
+    Messages live in a SQLite table ordered by an index on (state, priority DESC, queued_at), so taking the next message
+    is an index seek instead of a sort of every pending row. A sender claim()s a message, sends it and then ack()s it,
+    or release()s it if the send failed. Claims that are neither acked nor released within claim_timeout seconds (the
+    sender crashed) are handed out again, so a message is sent at least once.
+
+    The sheet stays the place messages arrive and sent stamps are exported to. refresh() only reads rows appended since
+    the last import. The first and the last imported row are read again to detect rows having been removed, inserted or
+    reordered, in which case every pending message is imported again. Claimed messages are left alone, so a sender
+    that is in the middle of sending one can still ack it.
+    """
+    COLUMNS = ["Message", "Recipient", "DateTimeQueued", "Priority", "LeadRowNum", "PhoneNumIndex", "DateTimeSent"]
+
+    def __init__(self, path: str, logger: logging.Logger, claim_timeout: float = 600):
+        self.logger = logger
+        self.claim_timeout = claim_timeout
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                queue_row_num INTEGER NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                queued_at REAL NOT NULL,
+                queued_raw TEXT NOT NULL,
+                lead_row_num INTEGER NOT NULL,
+                number_index INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                claimed_by TEXT,
+                claimed_at REAL,
+                sender TEXT,
+                sent_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS messages_next ON messages (state, priority DESC, queued_at, id);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front so two senders can never claim the same message
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _meta(self, name: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, name: str, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+    @staticmethod
+    def _row_fingerprint(row: dict) -> list:
+        return [str(row["Recipient"]), str(row["Message"]), str(row["DateTimeQueued"])]
+
+    def refresh(self, sheet_client):
+        """
+        Import messages appended to the Message Queue sheet since the last refresh.
+
+        :param sheet_client: A GoogleSheetClient with Message Queue open.
+        """
+        row_count = self._meta("row_count", 0)
+        start_row = 2
+        if row_count:
+            rows = sheet_client.read_columns(self.COLUMNS, start_row=row_count + 1)
+            last_imported = next(rows, None)
+            # The last imported row has to be found exactly where it was left, a blank row there means rows were removed
+            unchanged = (
+                last_imported is not None
+                and last_imported[0] == row_count + 1
+                and self._row_fingerprint(last_imported[1]) == self._meta("last_row")
+            )
+            if unchanged:
+                # read_columns reads lazily a chunk at a time, only the top of the sheet is fetched for the first row
+                first_row = next(sheet_client.read_columns(self.COLUMNS, chunk_rows=100), None)
+                unchanged = first_row is not None and (
+                    [first_row[0], *self._row_fingerprint(first_row[1])] == self._meta("first_row")
+                )
+            if unchanged:
+                start_row = row_count + 2
+            else:
+                self.logger.info("Message Queue rows changed since the last import, importing unsent messages again")
+                row_count = 0
+
+        if start_row == 2:
+            rows = sheet_client.read_columns(self.COLUMNS)
+
+        imported = []
+        first_row = None
+        last_row = None
+        for row_num, row in rows:
+            if first_row is None:
+                first_row = row_num, row
+            last_row = row_num, row
+            try:
+                if row["DateTimeSent"] or not str(row["Message"]) or not str(row["Recipient"]):
+                    continue
+
+                try:
+                    queued_at = parse_sheet_datetime(str(row["DateTimeQueued"])).timestamp()
+                except ValueError:
+                    self.logger.error(f"Could not parse DateTimeQueued in row number {row_num}, queuing it as of now")
+                    queued_at = time.time()
+
+                imported.append((
+                    row_num,
+                    str(row["Recipient"]),
+                    str(row["Message"]),
+                    int(row["Priority"] or 0),
+                    queued_at,
+                    str(row["DateTimeQueued"]),
+                    int(row["LeadRowNum"]) if row["LeadRowNum"] else 0,
+                    int(row["PhoneNumIndex"]) if row["PhoneNumIndex"] else 0
+                ))
+            except ValueError:
+                self.logger.warning(f"Skipping Message Queue row {row_num} with malformed values")
+
+        with self._transaction():
+            if start_row == 2:
+                # Sent messages are kept as history and claimed ones are being sent right now, only pending messages are
+                # re-imported from the sheet. Sent and claimed messages are matched on the DateTimeQueued cell as
+                # written in the sheet, which stays the same even when it does not parse. This happens inside the
+                # transaction so a message claimed meanwhile cannot be imported a second time
+                taken = set(self.conn.execute(
+                    "SELECT recipient, message, queued_raw FROM messages WHERE state IN ('sent', 'claimed')"
+                ))
+                # Rows may have moved, sent stamps have to be exported to where the message is now
+                self.conn.executemany(
+                    "UPDATE messages SET queue_row_num = ? "
+                    "WHERE recipient = ? AND message = ? AND queued_raw = ? AND state IN ('sent', 'claimed')",
+                    [
+                        (message[0], message[1], message[2], message[5])
+                        for message in imported if (message[1], message[2], message[5]) in taken
+                    ]
+                )
+                self.conn.execute("DELETE FROM messages WHERE state = 'pending'")
+                imported = [message for message in imported if (message[1], message[2], message[5]) not in taken]
+            self.conn.executemany(
+                "INSERT INTO messages "
+                "(queue_row_num, recipient, message, priority, queued_at, queued_raw, lead_row_num, number_index) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                imported
+            )
+            if start_row == 2 and first_row is not None:
+                self._set_meta("first_row", [first_row[0], *self._row_fingerprint(first_row[1])])
+            if last_row is not None:
+                self._set_meta("row_count", last_row[0] - 1)
+                self._set_meta("last_row", self._row_fingerprint(last_row[1]))
+            elif start_row == 2:
+                self._set_meta("row_count", 0)
+
+        self.logger.info(f"Outbox imported {len(imported)} messages, {self.pending_count()} pending")
+
+    def claim(self, worker: str = "") -> Union[None, dict]:
+        """
+        Take the highest priority, longest queued message for sending.
+
+        :param worker: Name of the claiming sender, for diagnostics.
+        :return: The message with its id, queue_row_num, recipient, message, priority, lead_row_num and number_index,
+            or None if nothing is pending.
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE messages SET state = 'pending', claimed_by = NULL, claimed_at = NULL "
+                "WHERE state = 'claimed' AND claimed_at < ?",
+                (now - self.claim_timeout,)
+            )
+            row = self.conn.execute(
+                "SELECT id, queue_row_num, recipient, message, priority, lead_row_num, number_index FROM messages "
+                "WHERE state = 'pending' ORDER BY priority DESC, queued_at, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.conn.execute(
+                "UPDATE messages SET state = 'claimed', claimed_by = ?, claimed_at = ? WHERE id = ?",
+                (worker, now, row[0])
+            )
+
+        return dict(zip(["id", "queue_row_num", "recipient", "message", "priority", "lead_row_num", "number_index"], row))
+
+    def ack(self, message_id: int, sender: str, sent_at: float = None):
+        """Marks a claimed message as sent"""
+        self.conn.execute(
+            "UPDATE messages SET state = 'sent', sender = ?, sent_at = ? WHERE id = ?",
+            (sender, time.time() if sent_at is None else sent_at, message_id)
+        )
+
+    def release(self, message_id: int):
+        """Puts a claimed message back in the queue, e.g. after a failed send"""
+        self.conn.execute(
+            "UPDATE messages SET state = 'pending', claimed_by = NULL, claimed_at = NULL WHERE id = ? AND state = 'claimed'",
+            (message_id,)
+        )
+
+    def pending_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE state = 'pending'").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -3,9 +3,17 @@ import json
 import logging
 import os
 import random
+import signal
+import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from clients import GoogleSheetClient, HushedClient
+from helpers import format_sheet_datetime, parse_sheet_datetimes
+from outbox import Outbox
+from storage import SendLedger
+from typing import Tuple, Union
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger("send_sms_logger")
@@ -15,18 +23,13 @@ logger.addHandler(file_handler)
 logger.setLevel(logging.INFO)
 
 
-def extend_and_add(lst, index, value, filler=""):
-    # Extend the list with the filler value up to the required index
-    if index >= len(lst):
-        lst.extend([filler] * (index - len(lst) + 1))
-
-    # Set the value at the desired index
-    lst[index] = value
-
-    return lst
-
-
-def calculate_msgs_to_send(msgs_left: int, send_prob: int, interval=3, current_time: datetime.datetime = None):
+def calculate_msgs_to_send(
+    msgs_left: int,
+    send_prob: int,
+    interval=3,
+    current_time: datetime.datetime = None,
+    max_per_interval: int = 4
+):
     if not current_time:
         current_time = datetime.datetime.now()
 
@@ -35,7 +38,6 @@ def calculate_msgs_to_send(msgs_left: int, send_prob: int, interval=3, current_t
 
     # Calculate the number of intervals left in the day
     intervals_left = max(int(mins_left) // interval, 1)
-    max_per_interval = 4
 
     msgs_to_send = msgs_left // intervals_left
 
@@ -45,143 +47,414 @@ def calculate_msgs_to_send(msgs_left: int, send_prob: int, interval=3, current_t
     return min(msgs_to_send, max_per_interval)
 
 
-def get_latest_phone_number(messages):
+def rebuild_send_ledger(ledger: SendLedger, messages: list):
+    """Replaces the send ledger with the sends recorded in the Message Queue sheet"""
+    sent_messages = [message for message in messages if message["DateTimeSent"] and message["SenderNumber"]]
+    sends = []
+    for message, datetime_sent in zip(sent_messages, parse_sheet_datetimes([message["DateTimeSent"] for message in sent_messages])):
+        if datetime_sent is None:
+            logger.error(f"Could not parse DateTimeSent \"{message['DateTimeSent']}\"")
+        else:
+            sends.append((str(message["SenderNumber"]), datetime_sent.timestamp()))
+
+    ledger.rebuild(sends)
+    logger.info(f"Send ledger rebuilt from {len(sends)} sent messages")
+
+
+def get_devices(config: dict) -> list:
+    """
+    Work out the devices to send from and the sender numbers each one sends from.
+
+    Devices come from config["devices"], each with a "uuid" and optionally the "numbers" logged in on it and the
+    "system_port" and "mjpeg_server_port" its Appium session uses (distinct defaults are picked when several devices
+    are configured). Numbers of numbers_for_send that no device lists are dealt round-robin to the devices without a
+    list. Without "devices" the phone_uuid device sends from every number.
+
+    :param config: The config.
+    :return: One dictionary per device with uuid, numbers, system_port and mjpeg_server_port.
+    :raises ValueError: If a device lists a number missing from numbers_for_send, the hourly caps would not count it.
+    """
+    numbers = [number.replace("+", "") for number in config["numbers_for_send"]]
+    if not config.get("devices"):
+        return [{"uuid": config["phone_uuid"], "numbers": numbers, "system_port": None, "mjpeg_server_port": None}]
+
+    devices = []
+    parallel = len(config["devices"]) > 1
+    for index, device in enumerate(config["devices"]):
+        devices.append({
+            "uuid": device["uuid"],
+            "numbers": [number.replace("+", "") for number in device.get("numbers", [])],
+            "system_port": device.get("system_port", 8200 + index if parallel else None),
+            "mjpeg_server_port": device.get("mjpeg_server_port", 7810 + index if parallel else None)
+        })
+
+    assigned = {number for device in devices for number in device["numbers"]}
+    unknown = sorted(assigned - set(numbers))
+    if unknown:
+        raise ValueError(f"Device numbers {', '.join(unknown)} are not in numbers_for_send")
+    unlisted = [device for device in devices if not device["numbers"]]
+    for index, number in enumerate([number for number in numbers if number not in assigned]):
+        if unlisted:
+            unlisted[index % len(unlisted)]["numbers"].append(number)
+
+    return [device for device in devices if device["numbers"]]
+
+
+def create_writers(sheet_client: GoogleSheetClient, config: dict) -> dict:
+    """
+    Create the buffered writers sent stamps are exported through.
+
+    Writes are flushed together, the short interval keeps sent stamps from lagging far behind the phones in case the
+    run dies mid way.
+
+    :param sheet_client: A GoogleSheetClient with Message Queue open.
+    :param config: The config.
+    :return: The Message Queue and Leads Master writers with the column numbers they write to.
+    """
+    leads_master_sheet_client = GoogleSheetClient(os.path.join(script_dir, "credentials-file.json"), "SAM", logger)
+    leads_master_sheet_client.open_sheet("Leads Master")
+
+    flush_interval = config.get("sheet_flush_interval", 10)
+    return {
+        "queue": sheet_client.writer(flush_interval=flush_interval),
+        "leads_master": leads_master_sheet_client.writer(flush_interval=flush_interval, raw=False),
+        "time_sent_col": sheet_client.get_column_index("DateTimeSent"),
+        "sender_number_col": sheet_client.get_column_index("SenderNumber"),
+        "sent_cols": {
+            1: leads_master_sheet_client.get_column_index("SMS1SentDateTime"),
+            2: leads_master_sheet_client.get_column_index("SMS2SentDateTime"),
+            3: leads_master_sheet_client.get_column_index("SMS3SentDateTime"),
+        }
+    }
+
+
+def claim_and_send(
+    client: HushedClient,
+    device: dict,
+    last_number: Union[None, str],
+    outbox: Outbox,
+    ledger: SendLedger,
+    config: dict,
+    hour_start: float,
+    writers: dict
+) -> Tuple[Union[None, dict], Union[None, str]]:
+    """
+    Claim the next message from the outbox and send it from one of the device's numbers.
+
+    The send first reserves a slot for its number in the shared send ledger, so the hourly limit of a number holds
+    across all devices and runs even when the number is logged in on more than one device. If the send fails the
+    message is released and the reservation cancelled before the error is raised.
+
+    :param client: The open HushedClient of the device.
+    :param device: The device, as returned by get_devices().
+    :param last_number: The number the device sent from last. With rotate_sender_numbers (the default) it is only picked
+        again when no other number is under its limit, otherwise it is tried first so the app can stay on its screen.
+    :param outbox: The outbox to claim from.
+    :param ledger: The send ledger.
+    :param config: The config.
+    :param hour_start: Start of the current hour as a POSIX timestamp.
+    :param writers: The shared Message Queue and Leads Master sheet writers and their column numbers.
+    :return: The message and the number it was sent from. The message is None when the outbox is empty, the number
+        is None when every number of the device reached its hourly limit.
     """
-    This function takes a list of dictionaries where each dictionary has a 'Message', 'DateTimeSent', and 'SenderNumber'.
-    It returns the phone number of the sender from the latest message.
+    device_uuid = device["uuid"]
+    message_to_send = outbox.claim(device_uuid)
+    if message_to_send is None:
+        return None, None
+
+    candidates = [number for number in device["numbers"] if number != last_number]
+    random.shuffle(candidates)
+    if last_number is not None:
+        if config.get("rotate_sender_numbers", True):
+            candidates.append(last_number)
+        else:
+            candidates.insert(0, last_number)
+
+    number_for_sending = None
+    send_id = None
+    for number in candidates:
+        send_id = ledger.reserve(number, hour_start, config["messages_per_hour"])
+        if send_id is not None:
+            number_for_sending = number
+            break
+
+    if number_for_sending is None:
+        outbox.release(message_to_send["id"])
+        return message_to_send, None
+
+    logger.info(f"[{device_uuid}] Sending \"{message_to_send['message']}\" to {message_to_send['recipient']} from {number_for_sending}")
+
+    try:
+        client.send_sms(f"+{number_for_sending}", message_to_send["recipient"], message_to_send["message"])
+    except BaseException:
+        outbox.release(message_to_send["id"])
+        ledger.cancel(send_id)
+        raise
+    time_sent = datetime.datetime.now()
+    time_sent_str = format_sheet_datetime(time_sent)
+    outbox.ack(message_to_send["id"], number_for_sending, time_sent.timestamp())
+
+    queue_row_num = message_to_send["queue_row_num"]
+    writers["queue"].update_cell(queue_row_num, writers["time_sent_col"], time_sent_str)
+    writers["queue"].update_cell(queue_row_num, writers["sender_number_col"], number_for_sending)
+    if message_to_send["lead_row_num"]:
+        row = message_to_send["lead_row_num"]
+        col = writers["sent_cols"][message_to_send["number_index"]]
+        logger.info(f"Sent datetime staged for Leads Master - Row: {row} Col: {col}")
+        writers["leads_master"].update_cell(row, col, time_sent_str)
+    logger.info(f"[{device_uuid}] Sent \"{message_to_send['message']}\" to {message_to_send['recipient']} from {number_for_sending}")
+
+    return message_to_send, number_for_sending
+
+
+def send_from_device(device: dict, num_messages: int, config: dict, hour_start: float, writers: dict) -> int:
     """
-    def parse_date(date_str):
+    Send up to num_messages messages from the outbox on one device, runs in its own worker thread.
+
+    :param device: The device, as returned by get_devices().
+    :param num_messages: How many messages this device should send.
+    :param config: The config.
+    :param hour_start: Start of the current hour as a POSIX timestamp.
+    :param writers: The shared Message Queue and Leads Master sheet writers and their column numbers.
+    :return: How many messages were sent.
+    """
+    ledger = SendLedger(os.path.join(script_dir, config.get("send_ledger_file", "send_ledger.sqlite3")))
+    outbox = Outbox(os.path.join(script_dir, config.get("outbox_file", "outbox.sqlite3")), logger)
+    device_uuid = device["uuid"]
+    last_number = None
+    sent = 0
+    try:
+        with HushedClient(
+            device_uuid,
+            logger,
+            config["appium_url"],
+            system_port=device["system_port"],
+            mjpeg_server_port=device["mjpeg_server_port"]
+        ) as client:
+            for x in range(num_messages):
+                logger.info(f"=========================================================")
+                logger.info(f"[{device_uuid}] Latest number used for sending: {last_number}")
+                message, number = claim_and_send(client, device, last_number, outbox, ledger, config, hour_start, writers)
+                if message is None:
+                    logger.info(f"[{device_uuid}] Outbox is empty")
+                    break
+                if number is None:
+                    logger.info(f"[{device_uuid}] Every number reached its hourly limit")
+                    break
+
+                sent += 1
+                last_number = number
+                if x != num_messages - 1:
+                    time.sleep(random.randint(25, 35))
+                logger.info(f"=========================================================")
+    finally:
+        outbox.close()
+        ledger.close()
+
+    return sent
+
+
+def send_messages(sheet_client: GoogleSheetClient, config: dict):
+    sheet_client.open_sheet("Message Queue")
+    ledger = SendLedger(os.path.join(script_dir, config.get("send_ledger_file", "send_ledger.sqlite3")))
+    try:
+        if not ledger.is_built or config.get("rebuild_send_ledger", False):
+            rebuild_send_ledger(ledger, sheet_client.read_records())
+        execution_time = datetime.datetime.now()
+
+        # Messages are sent from the outbox, the sheet is only read for rows appended since the last run
+        outbox = Outbox(os.path.join(script_dir, config.get("outbox_file", "outbox.sqlite3")), logger)
         try:
-            return datetime.datetime.strptime(date_str, '%m/%d/%Y %H:%M:%S')
-        except ValueError:
-            return datetime.datetime.min  # Return a minimal datetime for blank or incorrect formats
+            outbox.refresh(sheet_client)
+            pending_count = outbox.pending_count()
+        finally:
+            outbox.close()
+
+        # Sends are counted per calendar hour from the ledger
+        hour_start = execution_time.replace(minute=0, second=0, microsecond=0)
+        numbers = ledger.counts([number.replace("+", "") for number in config["numbers_for_send"]], hour_start.timestamp())
+
+        if pending_count:
+            logger.info(f"Message counts: {numbers}")
+            day_start = hour_start.replace(hour=0).timestamp()
+            logger.info(f"Messages sent today: {ledger.counts(list(numbers), day_start)}")
+
+            # Only devices with a number under its hourly limit take part, each one sending in its own worker
+            devices = [
+                device for device in get_devices(config)
+                if any(numbers.get(number, 0) < config["messages_per_hour"] for number in device["numbers"])
+            ]
+            if devices:
+                run_interval = config["leads_manager_run_interval"]
+                max_per_hour = config["messages_per_hour"] * len(config["numbers_for_send"])
+                chance_to_send_messages = config["chance_to_send"]
+                num_messages_to_send = calculate_msgs_to_send(
+                    max_per_hour - sum(numbers.values()),
+                    chance_to_send_messages,
+                    run_interval,
+                    max_per_interval=4 * len(devices)
+                )
+                logger.info(f"{pending_count} messages in queue and chose to send {num_messages_to_send} right now from {len(devices)} devices")
+                if num_messages_to_send:
+                    writers = create_writers(sheet_client, config)
+
+                    # The messages of this run are spread evenly, earlier devices take the remainder
+                    shares = [
+                        num_messages_to_send // len(devices) + (1 if index < num_messages_to_send % len(devices) else 0)
+                        for index in range(len(devices))
+                    ]
+                    with writers["queue"], writers["leads_master"], ThreadPoolExecutor(max_workers=len(devices)) as executor:
+                        futures = [
+                            (device, executor.submit(send_from_device, device, share, config, hour_start.timestamp(), writers))
+                            for device, share in zip(devices, shares) if share
+                        ]
+                        for device, future in futures:
+                            try:
+                                logger.info(f"Device {device['uuid']} sent {future.result()} messages")
+                            except Exception as e:
+                                logger.error(f"Device {device['uuid']} failed: {e}", exc_info=True)
+            else:
+                logger.info("Every number reached its hourly limit")
+        else:
+            logger.info("No messages to send in queue")
+    finally:
+        ledger.close()
+
+
+def run_device_daemon(device: dict, config: dict, writers: dict, stop: threading.Event):
+    """
+    Keep a warm session on one device and send from the outbox until stop is set, runs in its own worker thread.
 
-    # Sorting the list of dictionaries by 'DateTimeSent' after converting to datetime objects
-    messages_sorted = sorted(messages, key=lambda x: parse_date(x['DateTimeSent']) if x['DateTimeSent'] else datetime.datetime.min)
+    The session is opened once up front and checked before every send. It is only recreated when it stopped answering
+    or a send failed, and the Hushed app is brought back to the foreground if something else took over the screen.
+    While the outbox is empty or every number of the device is at its hourly limit the worker polls the outbox.
 
-    # Getting the last element from the sorted list to find the latest message
-    latest_message = messages_sorted[-1]
+    Sends are paced like send_messages paces a run: every leads_manager_run_interval minutes the device works out how
+    many messages it sends in that interval with calculate_msgs_to_send() and chance_to_send, capped at 4, and waits
+    for the next interval once they are sent.
+    """
+    ledger = SendLedger(os.path.join(script_dir, config.get("send_ledger_file", "send_ledger.sqlite3")))
+    outbox = Outbox(os.path.join(script_dir, config.get("outbox_file", "outbox.sqlite3")), logger)
+    poll_interval = config.get("sender_daemon_poll_interval", 15)
+    device_uuid = device["uuid"]
+    client = HushedClient(
+        device_uuid,
+        logger,
+        config["appium_url"],
+        system_port=device["system_port"],
+        mjpeg_server_port=device["mjpeg_server_port"]
+    )
+    run_interval = config["leads_manager_run_interval"]
+    last_number = None
+    healthy = False
+    budget = 0
+    interval_end = 0.0
+    try:
+        while not stop.is_set():
+            if time.time() >= interval_end:
+                interval_end = time.time() + run_interval * 60
+                hour_start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+                sent_this_hour = sum(ledger.counts(device["numbers"], hour_start).values())
+                budget = calculate_msgs_to_send(
+                    config["messages_per_hour"] * len(device["numbers"]) - sent_this_hour,
+                    config["chance_to_send"],
+                    run_interval
+                )
+                logger.info(f"[{device_uuid}] Chose to send {budget} messages in the next {run_interval} minutes")
+            if budget <= 0:
+                stop.wait(interval_end - time.time())
+                continue
+
+            try:
+                if not healthy or not client.is_alive():
+                    logger.info(f"[{device_uuid}] Starting Appium session")
+                    client.recreate()
+                    healthy = True
+                client.ensure_app_foreground()
+
+                hour_start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+                message, number = claim_and_send(client, device, last_number, outbox, ledger, config, hour_start, writers)
+            except Exception as e:
+                logger.error(f"[{device_uuid}] Send failed, recreating the session: {e}", exc_info=True)
+                healthy = False
+                stop.wait(poll_interval)
+                continue
+
+            if message is None or number is None:
+                stop.wait(poll_interval)
+                continue
+
+            last_number = number
+            budget -= 1
+            stop.wait(random.randint(25, 35))
+    finally:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"[{device_uuid}] Closing the session failed: {e}")
+        outbox.close()
+        ledger.close()
 
-    # Extracting and returning the 'SenderNumber' from the latest message
-    return latest_message['SenderNumber']
 
+def run_sender_daemon(sheet_client: GoogleSheetClient, config: dict):
+    """
+    Run a long-lived sender with one warm Appium session per device until SIGINT or SIGTERM.
 
-def send_messages(sheet_client: GoogleSheetClient, config: dict):
+    Unlike send_messages, sessions are not cold started every run: each device worker keeps its session and takes
+    messages from the outbox as they arrive. The main thread imports new Message Queue rows into the outbox every
+    sender_daemon_sheet_interval seconds, and sent stamps are exported through writers that flush on their timers.
+    """
     sheet_client.open_sheet("Message Queue")
-    messages = sheet_client.read_records()
-    time_sent_column_number = sheet_client.get_column_index("DateTimeSent")
-    sender_number_column_number = sheet_client.get_column_index("SenderNumber")
-    messages_to_send = []
-    execution_time = datetime.datetime.now()
-
-    numbers = {number.replace("+", ""): 0 for number in config["numbers_for_send"]}
-
-    for index, message in enumerate(messages):
-        row_num = index + 2
-        datetime_sent_str = message["DateTimeSent"]
-        datetime_queued_str = message["DateTimeQueued"]
-        message_str = str(message["Message"])
-        recipient_str = str(message["Recipient"])
-        sender_number = str(message["SenderNumber"])
-        lead_row_num = int(message["LeadRowNum"]) if message["LeadRowNum"] else 0
-        number_index = int(message["PhoneNumIndex"]) if message["PhoneNumIndex"] else 0
-        priority = int(message["Priority"])
+    ledger = SendLedger(os.path.join(script_dir, config.get("send_ledger_file", "send_ledger.sqlite3")))
+    try:
+        if not ledger.is_built or config.get("rebuild_send_ledger", False):
+            rebuild_send_ledger(ledger, sheet_client.read_records())
+    finally:
+        ledger.close()
+
+    outbox = Outbox(os.path.join(script_dir, config.get("outbox_file", "outbox.sqlite3")), logger)
+    sheet_interval = config.get("sender_daemon_sheet_interval", 60)
+    devices = get_devices(config)
+    writers = create_writers(sheet_client, config)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logger.info(f"Sender daemon starting on {len(devices)} devices")
+    with writers["queue"], writers["leads_master"], ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        futures = [executor.submit(run_device_daemon, device, config, writers, stop) for device in devices]
         try:
-            if not datetime_sent_str and message_str and recipient_str:
-                messages_to_send.append({
-                    "index": row_num - 2,
-                    "recipient": recipient_str,
-                    "message": message_str,
-                    "lead_row_num": lead_row_num,
-                    "number_index": number_index,
-                    "priority": priority,
-                    "datetime_queued": datetime_queued_str
-                })
-            elif message["DateTimeSent"] and sender_number:
+            while not stop.is_set():
                 try:
-                    datetime_sent = datetime.datetime.strptime(datetime_sent_str, "%m/%d/%Y %H:%M:%S")
-                    if datetime_sent.year == execution_time.year and datetime_sent.month == execution_time.month and datetime_sent.day == execution_time.day and datetime_sent.hour == execution_time.hour:
-                        numbers[sender_number] += 1
-                except KeyError as e:
-                    logger.warning(e, exc_info=True)
-                except ValueError:
-                    logger.error(f"Could not parse DateTimeSent in row number {row_num}")
-        except KeyError:
-            logger.warning(f"Skipping processing row {row_num} due to missing columns")
-
-    if messages_to_send:
-        messages_to_send = sorted(
-            messages_to_send,
-            key=lambda i: (-i['priority'], datetime.datetime.strptime(i['datetime_queued'], '%m/%d/%Y %H:%M:%S'))
-        )
-
-        logger.info(f"Message counts: {numbers}")
-        queued_messages = [[value for value in queued_message.values()] for queued_message in messages]
-        available_numbers = [key for key, value in numbers.items() if value < config["messages_per_hour"]]
-        if available_numbers:
-            run_interval = config["leads_manager_run_interval"]
-            max_per_hour = config["messages_per_hour"] * len(config["numbers_for_send"])
-            chance_to_send_messages = config["chance_to_send"]
-            num_messages_to_send = calculate_msgs_to_send(
-                max_per_hour - sum(numbers.values()),
-                chance_to_send_messages,
-                run_interval
-            )
-            logger.info(f"{len(messages_to_send)} messages in queue and chose to send {num_messages_to_send} right now")
-            if num_messages_to_send:
-                leads_master_sheet_client = GoogleSheetClient(os.path.join(script_dir, "credentials-file.json"), "SAM", logger)
-                leads_master_sheet_client.open_sheet("Leads Master")
-                msg_queued_col_numbers = {
-                    1: leads_master_sheet_client.get_column_index("SMS1SentDateTime"),
-                    2: leads_master_sheet_client.get_column_index("SMS2SentDateTime"),
-                    3: leads_master_sheet_client.get_column_index("SMS3SentDateTime"),
-                }
-
-                last_number = get_latest_phone_number(messages)
-                with HushedClient(config["phone_uuid"], logger, config["appium_url"]) as client:
-                    for x in range(num_messages_to_send):
-                        logger.info(f"=========================================================")
-                        logger.info(f"Latest number used for sending: {last_number}")
-                        logger.info(f"Available numbers: {available_numbers}")
-                        try:
-                            message_to_send = messages_to_send.pop(0)
-
-                            if len(available_numbers) > 1:
-                                number_for_sending = random.choice([number for number in available_numbers if number != last_number])
-                            else:
-                                number_for_sending = available_numbers[0]
-
-                            logger.info(f"Sending \"{message_to_send['message']}\" to {message_to_send['recipient']} from {number_for_sending}")
-
-                            client.send_sms(f"+{number_for_sending}", message_to_send["recipient"], message_to_send["message"])
-                            time_sent = datetime.datetime.now()
-
-                            queued_messages[message_to_send["index"]] = extend_and_add(queued_messages[message_to_send["index"]], time_sent_column_number - 1, time_sent.strftime("%m/%d/%Y %H:%M:%S"))
-                            queued_messages[message_to_send["index"]] = extend_and_add(queued_messages[message_to_send["index"]], sender_number_column_number - 1, number_for_sending)
-                            if message_to_send["lead_row_num"]:
-                                row = message_to_send["lead_row_num"]
-                                col = msg_queued_col_numbers[message_to_send["number_index"]]
-                                logger.info(f"Sent datetime written to Leads Master - Row: {row} Col: {col}")
-                                leads_master_sheet_client.sheet.update_cell(row, col, time_sent.strftime("%m/%d/%Y %H:%M:%S"))
-                            logger.info(f"Sent \"{message_to_send['message']}\" to {message_to_send['recipient']} from {number_for_sending}")
-
-                            numbers[number_for_sending] += 1
-                            available_numbers = [key for key, value in numbers.items() if value < config["messages_per_hour"]]
-                            last_number = number_for_sending
-                            if x != num_messages_to_send - 1:
-                                time.sleep(random.randint(25, 35))
-                        except IndexError as e:
-                            logger.error(e, exc_info=True)
-                        logger.info(f"=========================================================")
-                        sheet_client.sheet.update(queued_messages, "A2")
-    else:
-        logger.info("No messages to send in queue")
+                    outbox.refresh(sheet_client)
+                except Exception as e:
+                    logger.error(f"Importing from Message Queue failed: {e}", exc_info=True)
+                stop.wait(sheet_interval)
+        except KeyboardInterrupt:
+            stop.set()
+
+        logger.info("Sender daemon stopping")
+        for device, future in zip(devices, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Device {device['uuid']} failed: {e}", exc_info=True)
+
+    outbox.close()
 
 
 if __name__ == "__main__":
     with open(os.path.join(script_dir, 'config.json'), 'rb') as config_file:
         master_config = json.load(config_file)
 
-    google_sheet_client = GoogleSheetClient(os.path.join(script_dir, "credentials-file.json"), "SAM", logger)
+    mirror_file = master_config.get("sheet_mirror_file")
+    google_sheet_client = GoogleSheetClient(
+        os.path.join(script_dir, "credentials-file.json"),
+        "SAM",
+        logger,
+        mirror_path=os.path.join(script_dir, mirror_file) if mirror_file else None
+    )
 
-    send_messages(google_sheet_client, master_config)
+    if "--daemon" in sys.argv:
+        run_sender_daemon(google_sheet_client, master_config)
+    else:
+        send_messages(google_sheet_client, master_config)
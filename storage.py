@@ -0,0 +1,357 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from gspread.utils import numericise_all
+from typing import List, Dict, Tuple, Union
+
+
+class SheetMirror:
+    """
+    Local SQLite copy of worksheets from a spreadsheet.
+
+    Each worksheet is stored as its header row plus one row per sheet row, together with a hash of the row contents.
+    The mirror remembers the spreadsheet modified time it was last synced at so callers can skip fetching altogether
+    when nothing changed, and only rows whose hash changed (or which were added/removed) are rewritten on sync.
+
+    The Drive API only reports a modified time for the whole spreadsheet, so a write to any tab makes every mirrored
+    tab stale. The mirror saves transfers while the spreadsheet sits idle between reads, e.g. several reads within one
+    run or runs with nothing to write, not across runs that each write some tab.
+    """
+
+    def __init__(self, path: str, logger: logging.Logger):
+        self.path = path
+        self.logger = logger
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS worksheets (
+                name TEXT PRIMARY KEY,
+                header TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                modified_time TEXT
+            );
+            CREATE TABLE IF NOT EXISTS rows (
+                worksheet TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (worksheet, row_num)
+            );
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _hash_row(row: List[str]) -> str:
+        return hashlib.sha1(json.dumps(row).encode("utf-8")).hexdigest()
+
+    def is_current(self, worksheet_name: str, modified_time: str) -> bool:
+        """
+        Check if the mirrored worksheet was synced at the given spreadsheet modified time.
+
+        :param worksheet_name: The title of the worksheet.
+        :param modified_time: The modifiedTime reported by the Drive API for the spreadsheet.
+        :return: True if the mirror can be served without fetching from the sheet.
+        """
+        row = self.conn.execute(
+            "SELECT modified_time FROM worksheets WHERE name = ?", (worksheet_name,)
+        ).fetchone()
+
+        return row is not None and modified_time is not None and row[0] == modified_time
+
+    def sync(self, worksheet_name: str, values: List[List[str]], modified_time: str) -> int:
+        """
+        Bring the mirror in line with the given sheet values, only rewriting rows whose content changed.
+
+        :param worksheet_name: The title of the worksheet.
+        :param values: All values of the worksheet including the header row, as returned by get_all_values.
+        :param modified_time: The modifiedTime reported by the Drive API at the time values were fetched.
+        :return: The number of rows that were inserted, updated or deleted.
+        """
+        header = values[0] if values else []
+        rows = values[1:]
+
+        existing_hashes = dict(self.conn.execute(
+            "SELECT row_num, hash FROM rows WHERE worksheet = ?", (worksheet_name,)
+        ).fetchall())
+
+        changed = []
+        for index, row in enumerate(rows):
+            row_num = index + 2
+            row_hash = self._hash_row(row)
+            if existing_hashes.get(row_num) != row_hash:
+                changed.append((worksheet_name, row_num, row_hash, json.dumps(row)))
+
+        last_row = len(rows) + 1
+        removed = len([row_num for row_num in existing_hashes if row_num > last_row])
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rows (worksheet, row_num, hash, data) VALUES (?, ?, ?, ?)", changed
+            )
+            self.conn.execute("DELETE FROM rows WHERE worksheet = ? AND row_num > ?", (worksheet_name, last_row))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO worksheets (name, header, row_count, modified_time) VALUES (?, ?, ?, ?)",
+                (worksheet_name, json.dumps(header), len(rows), modified_time)
+            )
+
+        self.logger.info(f"Mirror of {worksheet_name} synced: {len(changed)} rows changed, {removed} rows removed")
+
+        return len(changed) + removed
+
+    def header(self, worksheet_name: str) -> List[str]:
+        row = self.conn.execute("SELECT header FROM worksheets WHERE name = ?", (worksheet_name,)).fetchone()
+
+        return json.loads(row[0]) if row else []
+
+    def values(self, worksheet_name: str) -> List[List[str]]:
+        """
+        Read the mirrored worksheet in the same shape as gspread's get_all_values, header row first.
+
+        :param worksheet_name: The title of the worksheet.
+        :return: A list of rows of raw cell strings.
+        """
+        values = [self.header(worksheet_name)]
+        for (data,) in self.conn.execute(
+            "SELECT data FROM rows WHERE worksheet = ? ORDER BY row_num", (worksheet_name,)
+        ):
+            values.append(json.loads(data))
+
+        return values
+
+    def records(self, worksheet_name: str) -> List[Dict[str, Union[int, float, str]]]:
+        """
+        Read the mirrored worksheet in the same shape as gspread's get_all_records.
+
+        :param worksheet_name: The title of the worksheet.
+        :return: A list of dictionaries keyed by the header row, with numeric strings numericised.
+        """
+        header = self.header(worksheet_name)
+        records = []
+        for (data,) in self.conn.execute(
+            "SELECT data FROM rows WHERE worksheet = ? ORDER BY row_num", (worksheet_name,)
+        ):
+            row = json.loads(data)
+            row.extend([""] * (len(header) - len(row)))
+            records.append(dict(zip(header, numericise_all(row))))
+
+        return records
+
+    def close(self):
+        self.conn.close()
+
+
+class AddressParseCache:
+    """
+    On-disk cache of parsed address components keyed by the raw address string.
+
+    Entries remember when they were last used and the least recently used ones are evicted once the cache grows past
+    max_entries. Writes are committed in batches, call close() (or flush()) to persist the tail.
+    """
+
+    def __init__(self, path: str, max_entries: int = 250000, commit_every: int = 500):
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS parsed_addresses (
+                raw TEXT PRIMARY KEY,
+                components TEXT NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS parsed_addresses_last_used ON parsed_addresses (last_used);
+            """
+        )
+        self.conn.commit()
+
+    def get(self, raw: str) -> Union[None, Tuple[str, str, str, str]]:
+        with self.lock:
+            row = self.conn.execute("SELECT components FROM parsed_addresses WHERE raw = ?", (raw,)).fetchone()
+            if row is None:
+                return None
+
+            self.conn.execute("UPDATE parsed_addresses SET last_used = ? WHERE raw = ?", (time.time(), raw))
+            self._after_write()
+
+        return tuple(json.loads(row[0]))
+
+    def put(self, raw: str, components: Tuple[str, str, str, str]):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO parsed_addresses (raw, components, last_used) VALUES (?, ?, ?)",
+                (raw, json.dumps(components), time.time())
+            )
+            self._after_write()
+
+    def _after_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self._flush()
+
+    def _flush(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM parsed_addresses").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM parsed_addresses WHERE raw IN "
+                "(SELECT raw FROM parsed_addresses ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+
+class SkipTraceCache:
+    """
+    Durable cache of skip trace results keyed by normalized contact address and owner name.
+
+    Empty results are cached too, so addresses BatchData had nothing for are not paid for again right away. They
+    expire after the much shorter empty_ttl_days, since an empty match may be a transient miss.
+    """
+
+    def __init__(self, path: str, ttl_days: float = 180, empty_ttl_days: float = 7):
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.empty_ttl_seconds = empty_ttl_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS skip_traces (
+                key TEXT PRIMARY KEY,
+                phone_numbers TEXT NOT NULL,
+                traced_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def get(self, key: str) -> Union[None, List[str]]:
+        """
+        Look up a cached result.
+
+        :param key: The cache key of the lead.
+        :return: The cached phone numbers (possibly empty), or None when there is no fresh entry.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT phone_numbers FROM skip_traces "
+                "WHERE key = ? AND traced_at >= CASE WHEN phone_numbers = '[]' THEN ? ELSE ? END",
+                (key, now - self.empty_ttl_seconds, now - self.ttl_seconds)
+            ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, phone_numbers: List[str]):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO skip_traces (key, phone_numbers, traced_at) VALUES (?, ?, ?)",
+                (key, json.dumps(phone_numbers), time.time())
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SendLedger:
+    """
+    Append-only record of every SMS sent, one row per send with the sender number and time.
+
+    Counts over a window are answered from an index on (sender, sent_at), so their cost depends on the sends inside
+    the window rather than the whole history. The ledger can be rebuilt from the Message Queue sheet at any time.
+    """
+
+    def __init__(self, path: str):
+        # Several senders may share the ledger, writers wait for each other instead of failing
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sends (
+                id INTEGER PRIMARY KEY,
+                sender TEXT NOT NULL,
+                sent_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sends_sender_sent_at ON sends (sender, sent_at);
+            CREATE INDEX IF NOT EXISTS sends_sent_at ON sends (sent_at);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL NOT NULL);
+            """
+        )
+        self.conn.commit()
+
+    @property
+    def is_built(self) -> bool:
+        """Whether the ledger has been rebuilt from the sheet at least once"""
+        return self.conn.execute("SELECT 1 FROM meta WHERE name = 'rebuilt_at'").fetchone() is not None
+
+    def reserve(self, sender: str, since: float, limit: int) -> Union[None, int]:
+        """
+        Record a send up front, only if the number is still under its limit for the window.
+
+        The check and the insert happen under one write lock, so the limit holds across every thread and process using
+        the ledger. Call cancel() with the returned id if the send then fails.
+
+        :param sender: The sender number, without a leading "+".
+        :param since: Start of the window as a POSIX timestamp.
+        :param limit: How many sends the number may have in the window.
+        :return: The id of the recorded send, or None if the number reached its limit.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.count(sender, since) >= limit:
+                return None
+
+            cursor = self.conn.execute("INSERT INTO sends (sender, sent_at) VALUES (?, ?)", (sender, time.time()))
+            return cursor.lastrowid
+        finally:
+            self.conn.commit()
+
+    def cancel(self, send_id: int):
+        """Removes a send recorded by reserve() that did not go out"""
+        with self.conn:
+            self.conn.execute("DELETE FROM sends WHERE id = ?", (send_id,))
+
+    def count(self, sender: str, since: float) -> int:
+        """
+        Count the sends of one number in a window.
+
+        :param sender: The sender number, without a leading "+".
+        :param since: Start of the window as a POSIX timestamp.
+        :return: How many messages the number sent at or after since.
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM sends WHERE sender = ? AND sent_at >= ?", (sender, since)
+        ).fetchone()[0]
+
+    def counts(self, senders: List[str], since: float) -> Dict[str, int]:
+        """Counts the sends of every given number at or after since, see count()"""
+        return {sender: self.count(sender, since) for sender in senders}
+
+    def rebuild(self, sends: List[Tuple[str, float]]):
+        """
+        Replace the whole ledger.
+
+        :param sends: (sender, sent_at) pairs, e.g. read from the Message Queue sheet.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM sends")
+            self.conn.executemany("INSERT INTO sends (sender, sent_at) VALUES (?, ?)", sends)
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('rebuilt_at', ?)", (time.time(),))
+
+    def close(self):
+        self.conn.close()